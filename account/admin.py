@@ -2,6 +2,15 @@ from django.contrib import admin
 from .models import *
 from django.utils.html import format_html
 import fullfii
+from django.db import transaction
+from chat.v4.consumers import ChatConsumer
+from fullfii.db.account import BlockGraph
+from fullfii.db.chat import (
+    bump_user_versions,
+    fan_out_private_rooms_of_owner,
+    get_talking_member_ids,
+    invalidate_room_feed,
+)
 
 
 @admin.register(Account)
@@ -52,6 +61,23 @@ class AccountAdmin(admin.ModelAdmin):
     format_is_ban.short_description = "良アカ (凍結されていない)"
     format_is_ban.admin_order_field = "is_ban"
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # 凍結・非表示・ブロック等の変更をフィード・トーク情報のETagへ反映
+        account = form.instance
+        invalidate_room_feed()
+        bump_user_versions(account.id, *get_talking_member_ids(account))
+        if "is_ban" in form.changed_data:
+            ChatConsumer.send_room_state_changed_of_member(account)
+
+        # ブロックの解除・凍結解除時, プライベートルームをinboxへ書き込み直す (BlockGraphの無効化後に)
+        blocked_account_ids = {
+            getattr(blocked_account, "pk", blocked_account)
+            for blocked_account in form.initial.get("blocked_accounts", [])
+        } | set(account.blocked_accounts.values_list("id", flat=True))
+        BlockGraph.invalidate(account.id, *blocked_account_ids)
+        transaction.on_commit(lambda: fan_out_private_rooms_of_owner(account))
+
 
 @admin.register(ProfileImage)
 class ProfileImageAdmin(admin.ModelAdmin):
@@ -239,6 +239,21 @@ class Account(AbstractBaseUser):
     objects = AccountManager()
 
 
+def render_std_image_variations(file_name, variations, storage):
+    """StdImageFieldのvariationを描画し, manifestに記録する"""
+    # fullfii.dbがmodelsをimportするため, 循環importを避けて関数内でimport
+    from fullfii.lib.image_variants import render_and_record_variations
+
+    return render_and_record_variations(file_name, variations, storage)
+
+
+def save_std_image_variants(instance, field_name):
+    """モデルのsave後に描画済みのvariation名を保存する"""
+    from fullfii.lib.image_variants import save_image_variants
+
+    save_image_variants(instance, field_name)
+
+
 def get_upload_to(instance, filename):
     pass
     media_dir_1 = str(instance.user.id)
@@ -259,7 +274,11 @@ class ProfileImage(models.Model):
             "thumbnail": (100, 100, True),
             "medium": (250, 250),
         },
+        render_variations=render_std_image_variations,
     )
+    picture_variants = models.CharField(
+        verbose_name="描画済みの画像サイズ", max_length=100, null=True, blank=True
+    )  # カンマ区切り. Noneは未記録
     upload_date = models.DateTimeField(verbose_name="アップロード日", default=timezone.now)
     user = models.OneToOneField(
         Account,
@@ -272,6 +291,10 @@ class ProfileImage(models.Model):
     def __str__(self):
         return str(self.user)
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        save_std_image_variants(self, "picture")
+
 
 class FavoriteUserRelationship(models.Model):
     class Meta:
@@ -0,0 +1,66 @@
+import os
+from account.models import Gender, Job, ProfileImage
+from fullfii.lib.constants import BASE_URL, USER_EMPTY_ICON_PATH
+from fullfii.db.account import exists_std_images
+
+
+### fast serializers ###
+# 読み取り専用. UserSerializerと同一の出力をDRFのフィールド処理を経由せずdictで生成する.
+# 出力の同一性はchat/tests/test_fast_serializers.pyで確認する.
+USER_EMPTY_ICON_URL = os.path.join(BASE_URL, USER_EMPTY_ICON_PATH)
+
+GENDER_DATA = {
+    g.value: {
+        "key": g.value,
+        "name": g.name,
+        "label": g.label if g != Gender.NOTSET else "性別内緒",
+    }
+    for g in Gender
+}
+JOB_DATA = {
+    j.value: {
+        "key": j.value,
+        "name": j.name,
+        "label": j.label if j != Job.SECRET else "職業内緒",
+    }
+    for j in Job
+}
+
+
+def format_datetime(value):
+    """strftime("%Y/%m/%d %H:%M:%S")と同一"""
+    if value:
+        return "{:04d}/{:02d}/{:02d} {:02d}:{:02d}:{:02d}".format(
+            value.year, value.month, value.day, value.hour, value.minute, value.second
+        )
+
+
+def build_media_url(image_url):
+    return os.path.join(BASE_URL, image_url if image_url[0] != "/" else image_url[1:])
+
+
+def get_user_image_url(user):
+    try:
+        profile_image = user.image
+    except ProfileImage.DoesNotExist:
+        return USER_EMPTY_ICON_URL
+
+    if exists_std_images(profile_image.picture):
+        return build_media_url(profile_image.picture.medium.url)
+    return build_media_url(profile_image.picture.url)
+
+
+def serialize_user(user):
+    """UserSerializer(user).dataと同一"""
+    return {
+        "id": str(user.id),
+        "name": user.username if user.username else "名無し",
+        "gender": dict(GENDER_DATA.get(user.gender, GENDER_DATA[Gender.NOTSET])),
+        "is_secret_gender": user.is_secret_gender,
+        "job": dict(JOB_DATA.get(user.job, JOB_DATA[Job.SECRET])),
+        "introduction": user.introduction,
+        "image": get_user_image_url(user),
+        "num_of_owner": user.num_of_owner,
+        "num_of_participated": user.num_of_participated,
+        "is_private_profile": user.is_private_profile,
+    }
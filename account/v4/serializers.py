@@ -105,11 +105,17 @@ class UserSerializer(serializers.ModelSerializer):
             return {"key": j.value, "name": j.name, "label": f"職業内緒"}
 
     def get_image(self, obj):
-        if ProfileImage.objects.filter(user=obj).exists():
-            if exists_std_images(obj.image.picture):
-                image_url = obj.image.picture.medium.url
+        # select_related("image")済みであればクエリは発行されない
+        try:
+            profile_image = obj.image
+        except ProfileImage.DoesNotExist:
+            profile_image = None
+
+        if profile_image is not None:
+            if exists_std_images(profile_image.picture):
+                image_url = profile_image.picture.medium.url
             else:
-                image_url = obj.image.picture.url
+                image_url = profile_image.picture.url
             return os.path.join(
                 BASE_URL, image_url if image_url[0] != "/" else image_url[1:]
             )
@@ -16,7 +16,17 @@ from account.v4.serializers import (
 )
 from account.models import Gender, ProfileImage, Account, Job, FavoriteUserRelationship
 from chat.models import RoomV4
+from fullfii.db.account import BlockGraph, load_accounts
+from fullfii.db.chat import (
+    bump_user_versions,
+    fan_out_private_rooms_of_owner,
+    get_talking_member_ids,
+    invalidate_room_feed,
+    invalidate_room_feed_of_owner,
+    remove_private_room_inbox,
+)
 from fullfii.lib.constants import api_class
+from main.v4.consumers import NotificationConsumer
 
 
 class SignupAPIView(views.APIView):
@@ -145,6 +155,9 @@ class MeAPIView(views.APIView):
 
         if serializer.is_valid():
             serializer.save()
+            invalidate_room_feed_of_owner(request.user)
+            # 自分と話しているユーザのトーク情報にもプロフィールが含まれるため
+            bump_user_versions(request.user.id, *get_talking_member_ids(request.user))
             return Response(
                 self.Serializer(request.user).data, status=status.HTTP_200_OK
             )
@@ -159,6 +172,9 @@ class MeAPIView(views.APIView):
     def delete(self, request):
         request.user.is_active = False
         request.user.save()
+        NotificationConsumer.send_feed_deltas_of_owner("removed", request.user)
+        invalidate_room_feed()
+        bump_user_versions(request.user.id, *get_talking_member_ids(request.user))
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
@@ -185,6 +201,8 @@ class ProfileImageAPIView(views.APIView):
 
         if profile_image_serializer.is_valid():
             profile_image_serializer.save()
+            invalidate_room_feed_of_owner(request.user)
+            bump_user_versions(request.user.id, *get_talking_member_ids(request.user))
             return Response(
                 self.Serializer(request.user).data, status=status.HTTP_201_CREATED
             )
@@ -215,6 +233,10 @@ class GenderAPIView(views.APIView):
             elif request.data["key"] == "secret":
                 request.user.is_secret_gender = True
             request.user.save()
+            # 性別によってルームの表示対象が変わるため
+            invalidate_room_feed()
+            bump_user_versions(request.user.id, *get_talking_member_ids(request.user))
+            NotificationConsumer.send_feed_deltas_of_owner("updated", request.user)
             return Response(
                 {
                     "me": MeSerializer(request.user).data,
@@ -249,6 +271,7 @@ class HiddenRoomsAPIView(views.APIView):
 
         request.user.hidden_rooms.add(room.id)
         request.user.save()
+        bump_user_versions(request.user.id)
         return Response(status=status.HTTP_200_OK)
 
     @swagger_auto_schema(
@@ -262,6 +285,7 @@ class HiddenRoomsAPIView(views.APIView):
         """
         request.user.hidden_rooms.clear()
         request.user.save()
+        bump_user_versions(request.user.id)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
@@ -289,6 +313,7 @@ class BlockedRoomsAPIView(views.APIView):
 
         request.user.blocked_rooms.add(room.id)
         request.user.save()
+        bump_user_versions(request.user.id)
         return Response(status=status.HTTP_200_OK)
 
 
@@ -311,6 +336,10 @@ class BlockedAccountsAPIView(views.APIView):
 
         request.user.blocked_accounts.add(user.id)
         request.user.save()
+        BlockGraph.invalidate(request.user.id, user.id)
+        remove_private_room_inbox(owner=request.user, recipient=user)
+        remove_private_room_inbox(owner=user, recipient=request.user)
+        bump_user_versions(request.user.id, user.id)
         return Response(status=status.HTTP_200_OK)
 
 
@@ -340,7 +369,7 @@ class FavoritesUsersAPIView(views.APIView):
         id_list = list(
             favorite_users_ids[self.paginate_by * (page - 1) : self.paginate_by * page]
         )
-        favorite_users = [Account.objects.get(id=pk) for pk in id_list]
+        favorite_users = load_accounts(id_list)
 
         serializer = UserSerializer(favorite_users, many=True)
         return Response(
@@ -368,6 +397,8 @@ class FavoritesUsersAPIView(views.APIView):
             FavoriteUserRelationship.objects.create(
                 owner=request.user, favorite_account=favorite_account
             )
+            fan_out_private_rooms_of_owner(request.user, favorite_account.id)
+            bump_user_versions(request.user.id)
         return Response(status=status.HTTP_200_OK)
 
 
@@ -390,6 +421,8 @@ class FavoritesUsersDetailAPIView(views.APIView):
         if favorite_user_relationships.exists():
             favorite_user_relationship = favorite_user_relationships.first()
             favorite_user_relationship.delete()
+            remove_private_room_inbox(owner=request.user, recipient=favorite_account)
+            bump_user_versions(request.user.id, favorite_account.id)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
 
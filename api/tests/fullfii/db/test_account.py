@@ -0,0 +1,21 @@
+import uuid
+
+from django.test import TestCase
+
+from account.tests.factories import AccountFactory
+from fullfii.db.account import load_accounts
+
+
+class TestLoadAccounts(TestCase):
+    def test_load_accounts(self):
+        accounts = [AccountFactory() for _ in range(3)]
+        id_list = [accounts[2].id, uuid.uuid4(), accounts[0].id]
+        with self.assertNumQueries(1):
+            loaded_accounts = load_accounts(id_list)
+            for account in loaded_accounts:
+                self.assertFalse(hasattr(account, "image"), msg="画像なしは追加クエリなしで判定できる")
+        self.assertEquals(
+            [account.id for account in loaded_accounts],
+            [accounts[2].id, accounts[0].id],
+            msg="id_listの順序で, 存在するもののみ返る",
+        )
@@ -0,0 +1,336 @@
+import uuid
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from django.test import TestCase
+from django.utils import timezone
+
+from account.models import Gender
+from account.tests.factories import AccountFactory
+from chat.models import MessageV4, PrivateRoomInbox
+from chat.tests.factories import RoomV4Factory
+from fullfii.db.chat import (
+    FeedEntry,
+    FeedSegmentKey,
+    FeedViewerExclusion,
+    RoomFeedQueryEngine,
+    RoomFeedVisibilityEngine,
+    close_room_for_member,
+    create_messages_with_seq,
+    get_not_stored_messages,
+    get_private_room_ids,
+    get_room_message_history,
+    get_total_unread_count,
+    get_unread_message_count,
+    mark_message_stored,
+    mark_room_messages_read,
+)
+
+
+def gene_viewer(gender=Gender.MALE, is_secret_gender=False, is_ban=False):
+    return SimpleNamespace(
+        id=uuid.uuid4(), gender=gender, is_secret_gender=is_secret_gender, is_ban=is_ban
+    )
+
+
+class TestRoomFeedVisibilityEngine(TestCase):
+    def setUp(self):
+        self.female_key = FeedSegmentKey(Gender.FEMALE, False, False, False)
+        self.female_exclude_key = FeedSegmentKey(Gender.FEMALE, False, False, True)
+        self.banned_male_key = FeedSegmentKey(Gender.MALE, False, True, False)
+        self.secret_exclude_key = FeedSegmentKey(Gender.FEMALE, True, False, True)
+
+        base_time = datetime(2021, 4, 1)
+        self.segments = {}
+        for i, segment_key in enumerate(
+            [
+                self.female_key,
+                self.female_exclude_key,
+                self.banned_male_key,
+                self.secret_exclude_key,
+            ]
+            * 3
+        ):
+            self.segments.setdefault(segment_key, []).insert(
+                0, FeedEntry(base_time + timedelta(minutes=i), uuid.uuid4(), uuid.uuid4())
+            )
+        self.engine = RoomFeedVisibilityEngine(self.segments)
+
+    def test_is_segment_visible(self):
+        is_visible = RoomFeedVisibilityEngine.is_segment_visible
+        male = gene_viewer(Gender.MALE)
+        female = gene_viewer(Gender.FEMALE)
+        secret = gene_viewer(Gender.FEMALE, is_secret_gender=True)
+        banned = gene_viewer(Gender.MALE, is_ban=True)
+
+        self.assertTrue(is_visible(self.female_key, male), msg="通常ルームは表示")
+        self.assertFalse(is_visible(self.female_exclude_key, male), msg="異性非表示")
+        self.assertTrue(is_visible(self.female_exclude_key, female), msg="同性は表示")
+        self.assertFalse(is_visible(self.female_exclude_key, secret), msg="性別内緒は非表示")
+        self.assertTrue(is_visible(self.secret_exclude_key, male), msg="オーナー性別内緒は表示")
+        self.assertFalse(is_visible(self.female_key, banned), msg="凍結ユーザに女性は非表示")
+        self.assertFalse(is_visible(self.banned_male_key, female), msg="女性に凍結ユーザは非表示")
+        self.assertTrue(is_visible(self.banned_male_key, male), msg="男性に凍結ユーザは表示")
+
+    def test_get_visible_room_ids(self):
+        female = gene_viewer(Gender.FEMALE)
+        excluded_entry = self.segments[self.female_key][0]
+        exclusion = FeedViewerExclusion({excluded_entry.id}, set())
+
+        expected_entries = sorted(
+            [
+                entry
+                for segment_key in [
+                    self.female_key,
+                    self.female_exclude_key,
+                    self.secret_exclude_key,
+                ]
+                for entry in self.segments[segment_key]
+                if entry != excluded_entry
+            ],
+            reverse=True,
+        )
+        expected_ids = [entry.id for entry in expected_entries]
+
+        id_list, has_more, next_cursor = self.engine.get_visible_room_ids(
+            female, exclusion, 5, cursor=""
+        )
+        self.assertEquals(id_list, expected_ids[:5], msg="新しい順に取得")
+        self.assertTrue(has_more, msg="続きがある")
+
+        id_list, has_more, next_cursor = self.engine.get_visible_room_ids(
+            female, exclusion, 5, cursor=next_cursor
+        )
+        self.assertEquals(id_list, expected_ids[5:], msg="カーソル以降を取得")
+        self.assertFalse(has_more, msg="続きがない")
+        self.assertIsNone(next_cursor, msg="次のカーソルがない")
+
+        id_list, _, _ = self.engine.get_visible_room_ids(
+            female, exclusion, 5, offset=5
+        )
+        self.assertEquals(id_list, expected_ids[5:], msg="offsetで取得")
+
+
+class TestRoomFeedQueryEngine(TestCase):
+    def test_get_visible_room_ids(self):
+        owners = [
+            AccountFactory(gender=Gender.FEMALE),
+            AccountFactory(gender=Gender.MALE, is_ban=True),
+            AccountFactory(gender=Gender.MALE),
+            AccountFactory(gender=Gender.NOTSET),
+            AccountFactory(gender="unknown"),  # 列挙値以外の性別
+        ]
+        now = timezone.now()
+        rooms = [
+            RoomV4Factory(
+                owner=owner,
+                is_exclude_different_gender=i % 2 == 0,
+                is_active=True,
+                created_at=now - timedelta(minutes=i),
+            )
+            for i, owner in enumerate(owners * 3)
+        ]
+        snapshot_engine = RoomFeedVisibilityEngine.build()
+        query_engine = RoomFeedQueryEngine()
+        exclusion = FeedViewerExclusion({rooms[0].id}, {owners[2].id})
+
+        viewer = AccountFactory(gender=Gender.MALE, is_secret_gender=False)
+        id_list, has_more, _ = query_engine.get_visible_room_ids(
+            viewer, exclusion, 3
+        )
+        self.assertEquals(
+            id_list, [rooms[1].id, rooms[3].id, rooms[5].id], msg="表示可能なルーム"
+        )
+        self.assertEquals(has_more, True, msg="次のページあり")
+
+        for viewer in [
+            AccountFactory(gender=Gender.FEMALE, is_secret_gender=False),
+            AccountFactory(gender=Gender.MALE, is_secret_gender=False, is_ban=True),
+            AccountFactory(gender=Gender.NOTSET, is_secret_gender=False),
+            AccountFactory(gender="unknown", is_secret_gender=False),
+        ]:
+            expected = snapshot_engine.get_visible_room_ids(viewer, exclusion, 3)
+            self.assertEquals(
+                query_engine.get_visible_room_ids(viewer, exclusion, 3),
+                expected,
+                msg="snapshotと同じ結果",
+            )
+            self.assertEquals(len(expected[0]), 3, msg="1ページ分のルーム")
+            self.assertEquals(expected[1], True, msg="次のページあり")
+            self.assertEquals(
+                query_engine.get_visible_room_ids(
+                    viewer, exclusion, 3, cursor=expected[2]
+                ),
+                snapshot_engine.get_visible_room_ids(
+                    viewer, exclusion, 3, cursor=expected[2]
+                ),
+                msg="cursor指定時もsnapshotと同じ結果",
+            )
+
+
+class TestPrivateRoomFeed(TestCase):
+    def test_talking_member(self):
+        viewer = AccountFactory()
+        partner = AccountFactory()
+        RoomV4Factory(owner=partner, participants=[viewer], is_active=True)
+        private_room = RoomV4Factory(owner=partner, is_private=True, is_active=True)
+        PrivateRoomInbox.objects.create(recipient=viewer, room=private_room)
+
+        id_list, _ = get_private_room_ids(
+            viewer, FeedViewerExclusion.create(viewer, exclude_talking_members=False), 10
+        )
+        self.assertEquals(
+            id_list, [private_room.id], msg="会話中のユーザのプライベートルームも表示する"
+        )
+        self.assertEquals(
+            partner.id in FeedViewerExclusion.create(viewer).owner_ids,
+            True,
+            msg="ルーム一覧では会話中のユーザを除外する",
+        )
+
+
+class TestRoomMemberWatermark(TestCase):
+    def setUp(self):
+        self.me = AccountFactory()
+        self.room = RoomV4Factory(owner=self.me)
+        base_time = datetime(2021, 4, 1)
+        self.messages = [
+            MessageV4.objects.create(
+                room=self.room,
+                sender=self.me,
+                text=str(i),
+                time=base_time + timedelta(minutes=i),
+            )
+            for i in range(5)
+        ]
+
+    def test_read(self):
+        self.assertEquals(
+            get_unread_message_count(self.me, [self.room]), 5, msg="位置未作成は全て未読"
+        )
+        mark_room_messages_read(self.me.id, self.room.id, self.messages[2].time)
+        self.assertEquals(get_unread_message_count(self.me, [self.room]), 2, msg="位置以降が未読")
+        mark_room_messages_read(self.me.id, self.room.id, self.messages[0].time)
+        self.assertEquals(get_unread_message_count(self.me, [self.room]), 2, msg="後退しない")
+
+    def test_stored(self):
+        mark_message_stored(self.me.id, self.messages[3].id)
+        self.assertEquals(
+            list(get_not_stored_messages(self.me, self.room)),
+            [self.messages[4]],
+            msg="保存済み位置以降のみ",
+        )
+        self.assertEquals(
+            get_total_unread_count(self.me), 5, msg="保存時に作成した位置の未読数は全メッセージ数"
+        )
+        mark_message_stored(self.me.id, self.messages[1].id)
+        self.assertEquals(
+            list(get_not_stored_messages(self.me, self.room)),
+            [self.messages[4]],
+            msg="位置は後退しない",
+        )
+
+
+class TestRoomMessageHistory(TestCase):
+    def setUp(self):
+        self.me = AccountFactory()
+        self.room = RoomV4Factory(owner=self.me)
+        base_time = datetime(2021, 4, 1)
+        self.messages = [
+            MessageV4.objects.create(
+                room=self.room,
+                sender=self.me,
+                text=str(i),
+                time=base_time + timedelta(minutes=i),
+            )
+            for i in range(5)
+        ]
+
+    def test_get_room_message_history(self):
+        messages, has_more, next_cursor = get_room_message_history(self.room, None, 2)
+        self.assertEquals(messages, self.messages[3:], msg="最新から時系列順")
+        self.assertTrue(has_more)
+
+        messages, has_more, next_cursor = get_room_message_history(
+            self.room, next_cursor, 2
+        )
+        self.assertEquals(messages, self.messages[1:3], msg="cursorより古いメッセージ")
+
+        messages, has_more, next_cursor = get_room_message_history(
+            self.room, next_cursor, 2
+        )
+        self.assertEquals(messages, self.messages[:1], msg="最後のページ")
+        self.assertFalse(has_more)
+        self.assertEquals(next_cursor, None)
+
+
+class TestUnreadCount(TestCase):
+    def setUp(self):
+        self.me = AccountFactory()
+        self.participant = AccountFactory()
+        self.room = RoomV4Factory(owner=self.me)
+        self.room.participants.add(self.participant)
+        base_time = datetime(2021, 4, 1)
+        self.messages = create_messages_with_seq(
+            [
+                MessageV4(
+                    room=self.room,
+                    sender=self.participant,
+                    text=str(i),
+                    time=base_time + timedelta(minutes=i),
+                )
+                for i in range(3)
+            ]
+        )
+
+    def test_unread_count(self):
+        self.assertEquals(get_total_unread_count(self.me), 3, msg="作成時に加算される")
+        create_messages_with_seq(self.messages[:1])
+        self.assertEquals(get_total_unread_count(self.me), 3, msg="再送は加算されない")
+
+        mark_room_messages_read(self.me.id, self.room.id, self.messages[1].time)
+        self.assertEquals(get_total_unread_count(self.me), 1, msg="既読時に再計算される")
+        self.assertEquals(
+            get_total_unread_count(self.me),
+            get_unread_message_count(self.me, [self.room]),
+        )
+
+        create_messages_with_seq(
+            [
+                MessageV4(
+                    room=self.room,
+                    sender=self.participant,
+                    text="既読位置より前",
+                    time=self.messages[0].time + timedelta(seconds=30),
+                )
+            ]
+        )
+        self.assertEquals(
+            get_total_unread_count(self.me), 1, msg="既読位置より前のメッセージは加算されない"
+        )
+
+        close_room_for_member(self.room, self.participant.id)
+        self.assertEquals(get_total_unread_count(self.participant), 0, msg="クローズ時に0")
+
+    def test_message_id_conflict(self):
+        other_room = RoomV4Factory(owner=self.participant)
+        message = MessageV4(
+            id=self.messages[0].id,
+            room=other_room,
+            sender=self.participant,
+            text="他のルーム",
+            time=self.messages[2].time + timedelta(minutes=1),
+        )
+        self.assertEquals(
+            create_messages_with_seq([message]),
+            [],
+            msg="他のルームで使用されているmessage_idは保存しない",
+        )
+        self.assertEquals(
+            MessageV4.objects.get(id=self.messages[0].id).room_id,
+            self.room.id,
+            msg="保存済みのメッセージは変わらない",
+        )
+        self.assertEquals(
+            MessageV4.objects.filter(room=other_room).count(), 0, msg="他のルームに保存されない"
+        )
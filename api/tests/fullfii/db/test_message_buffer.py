@@ -0,0 +1,59 @@
+import uuid
+
+from django.test import TestCase
+
+from account.tests.factories import AccountFactory
+from chat.models import MessageV4
+from chat.tests.factories import RoomV4Factory
+from fullfii.db.message_buffer import MessageWriteBuffer
+
+
+class TestMessageWriteBuffer(TestCase):
+    def test_flush(self):
+        me = AccountFactory()
+        room = RoomV4Factory(owner=me)
+        buffer = MessageWriteBuffer(flush_interval=60, max_size=100)
+
+        messages = [MessageV4(room=room, sender=me, text=str(i)) for i in range(3)]
+        for message in messages:
+            buffer.add(message)
+        buffer.add(messages[0])  # 再送
+        self.assertEquals(buffer.metrics["depth"], 3, msg="同一message_idは1件")
+        self.assertEquals(MessageV4.objects.count(), 0, msg="flushまで保存されない")
+
+        buffer.flush()
+        self.assertEquals(MessageV4.objects.count(), 3, msg="まとめて保存される")
+        self.assertEquals(
+            list(MessageV4.objects.order_by("time").values_list("seq", flat=True)),
+            [1, 2, 3],
+            msg="時刻順に採番される",
+        )
+
+        buffer.add(messages[1])
+        buffer.flush()
+        self.assertEquals(MessageV4.objects.count(), 3, msg="保存済みのメッセージは無視される")
+        self.assertEquals(buffer.metrics["flushed_messages"], 4)
+        self.assertEquals(buffer.metrics["depth"], 0)
+
+    def test_flush_failure(self):
+        me = AccountFactory()
+        room = RoomV4Factory(owner=me)
+        buffer = MessageWriteBuffer(flush_interval=60, max_size=100, max_retries=2)
+
+        message = MessageV4(room=room, sender=me, text="ok")
+        broken_message = MessageV4(room_id=uuid.uuid4(), sender=me, text="broken")
+        buffer.add(message)
+        buffer.add(broken_message)
+
+        buffer.flush()
+        self.assertEquals(
+            list(MessageV4.objects.values_list("id", flat=True)),
+            [message.id],
+            msg="保存できないメッセージがあっても他のメッセージは保存される",
+        )
+        self.assertEquals(buffer.metrics["depth"], 1, msg="失敗したメッセージのみ再試行")
+
+        buffer.flush()
+        self.assertEquals(buffer.metrics["depth"], 0, msg="max_retries回失敗したら破棄")
+        self.assertEquals(list(buffer.dead_letters), [broken_message])
+        self.assertEquals(buffer.metrics["dropped_messages"], 1)
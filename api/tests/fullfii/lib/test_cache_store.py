@@ -0,0 +1,39 @@
+from django.test import TestCase
+
+from fullfii.lib.cache_store import LocalCacheStore
+
+
+class TestLocalCacheStore(TestCase):
+    def setUp(self):
+        self.store = LocalCacheStore()
+
+    def test_get_set(self):
+        self.assertIsNone(self.store.get("key"), msg="未登録はNone")
+        value = {"ids": ["a", "b"]}
+        self.store.set("key", value)
+        value["ids"].append("c")
+        self.assertEquals(self.store.get("key"), {"ids": ["a", "b"]}, msg="登録時の値が返る")
+
+        self.store.set_many({"key1": 1, "key2": 2})
+        self.assertEquals(
+            self.store.get_many(["key1", "key2", "key3"]),
+            {"key1": 1, "key2": 2},
+            msg="登録済みのキーのみ返る",
+        )
+
+        self.store.delete("key", "key1")
+        self.assertIsNone(self.store.get("key"), msg="削除されている")
+        self.assertIsNone(self.store.get("key1"), msg="削除されている")
+
+    def test_timeout(self):
+        self.store.set("key", 1, timeout=0)
+        self.assertIsNone(self.store.get("key"), msg="期限切れはNone")
+
+    def test_incr(self):
+        self.assertEquals(self.store.incr("counter"), 1, msg="未登録は1から")
+        self.assertEquals(self.store.incr("counter"), 2, msg="インクリメントされる")
+
+    def test_add(self):
+        self.assertTrue(self.store.add("key", 1), msg="未登録は登録される")
+        self.assertFalse(self.store.add("key", 2), msg="登録済みは上書きしない")
+        self.assertEquals(self.store.get("key"), 1)
@@ -0,0 +1,56 @@
+from types import SimpleNamespace
+
+from django.test import TestCase
+
+from fullfii.lib.fcm_dispatcher import FakeFCMTransport, FCMDispatcher, FCMSendError
+
+
+def build_message(to_user, action):
+    if action["type"] != "SEND_MESSAGE_V4":
+        return
+    return SimpleNamespace(token=to_user.device_token, text=action["text"])
+
+
+def gene_user(token):
+    return SimpleNamespace(device_token=token)
+
+
+class TestFCMDispatcher(TestCase):
+    def test_batch(self):
+        transport = FakeFCMTransport()
+        dispatcher = FCMDispatcher(transport, build_message, batch_size=2, backoff=0)
+        for token in ["a", "b", "c"]:
+            dispatcher.enqueue(gene_user(token), {"type": "SEND_MESSAGE_V4", "text": "x"})
+        dispatcher.enqueue(gene_user("d"), {"type": "UNKNOWN"})
+        self.assertEquals(transport.sent_batches, [], msg="enqueue時は送信しない")
+
+        dispatcher.dispatch_pending()
+        self.assertEquals(
+            transport.sent_batches, [["a", "b"], ["c"]], msg="batch_size件ずつ送信される"
+        )
+        self.assertEquals(dispatcher.metrics["sent"], 3)
+
+    def test_retry(self):
+        transport = FakeFCMTransport(
+            failures={
+                "a": [FCMSendError("unavailable", retryable=True)],
+                "b": [FCMSendError("unregistered")],
+                "c": [FCMSendError("unavailable", retryable=True)] * 3,
+            }
+        )
+        dispatcher = FCMDispatcher(transport, build_message, max_retries=2, backoff=0)
+        for token in ["a", "b", "c"]:
+            dispatcher.enqueue(gene_user(token), {"type": "SEND_MESSAGE_V4", "text": "x"})
+        dispatcher.dispatch_pending()
+
+        self.assertEquals(
+            transport.sent_batches,
+            [["a", "b", "c"], ["a", "c"], ["c"]],
+            msg="retryableなエラーのみ再送される",
+        )
+        self.assertEquals(dispatcher.metrics["sent"], 1)
+        self.assertEquals(
+            [token for token, _ in dispatcher.failures],
+            ["b", "c"],
+            msg="再送上限を超えたものとretryableでないものは失敗として記録される",
+        )
@@ -0,0 +1,42 @@
+from types import SimpleNamespace
+
+from django.test import TestCase
+
+from fullfii.lib.image_variants import (
+    get_saved_image_variants,
+    record_image_variants,
+)
+
+
+def gene_image_field(name, picture_variants):
+    return SimpleNamespace(
+        name=name,
+        field=SimpleNamespace(name="picture"),
+        instance=SimpleNamespace(picture_variants=picture_variants),
+    )
+
+
+class TestImageVariants(TestCase):
+    def test_get_saved_image_variants(self):
+        record_image_variants("profile_images/a.jpg", ["large", "medium", "thumbnail"])
+
+        self.assertEquals(
+            get_saved_image_variants(gene_image_field("profile_images/a.jpg", "large")),
+            frozenset(["large"]),
+            msg="モデルに保存済みの値を優先する",
+        )
+        self.assertEquals(
+            get_saved_image_variants(gene_image_field("profile_images/a.jpg", "")),
+            frozenset(),
+            msg="空文字は描画済みのvariationなし",
+        )
+        self.assertEquals(
+            get_saved_image_variants(gene_image_field("profile_images/a.jpg", None)),
+            frozenset(["large", "medium", "thumbnail"]),
+            msg="未保存の場合manifestを参照する",
+        )
+        self.assertEquals(
+            get_saved_image_variants(gene_image_field("profile_images/b.jpg", None)),
+            frozenset(),
+            msg="未記録",
+        )
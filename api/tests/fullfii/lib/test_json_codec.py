@@ -0,0 +1,38 @@
+import io
+import uuid
+from datetime import datetime
+
+from django.test import TestCase
+
+from fullfii.lib import json_codec
+
+
+class TestJSONCodec(TestCase):
+    def test_dumps_loads(self):
+        pk = uuid.uuid4()
+        time = datetime(2021, 4, 1, 12, 30, 15, 123456)
+        text = json_codec.dumps({"id": pk, "time": time, "text": "こんにちは", 1: None})
+        self.assertEquals(
+            json_codec.loads(text),
+            {
+                "id": str(pk),
+                "time": "2021-04-01T12:30:15.123456",
+                "text": "こんにちは",
+                "1": None,
+            },
+            msg="UUID, datetimeは文字列で出力される",
+        )
+        self.assertEquals(
+            json_codec.loads(json_codec.dumps_bytes([1, "a"])),
+            [1, "a"],
+            msg="bytesも読み込める",
+        )
+
+    def test_renderer_parser(self):
+        data = {"rooms": [{"id": "a", "is_end": False}], "has_more": True}
+        rendered = json_codec.JSONRenderer().render(data)
+        self.assertIsInstance(rendered, bytes, msg="bytesで出力される")
+        self.assertEquals(
+            json_codec.JSONParser().parse(io.BytesIO(rendered)), data, msg="復元できる"
+        )
+        self.assertEquals(json_codec.JSONRenderer().render(None), b"", msg="Noneは空")
@@ -0,0 +1,21 @@
+import uuid
+from datetime import datetime
+
+from django.test import TestCase
+
+from fullfii.lib.pagination import InvalidCursorError, decode_cursor, encode_cursor
+
+
+class TestPagination(TestCase):
+    def test_encode_decode_cursor(self):
+        time = datetime(2021, 4, 1, 12, 30, 15, 123456)
+        pk = uuid.uuid4()
+        cursor = encode_cursor(time, pk)
+        self.assertNotIn("=", cursor, msg="パディングが除去されている")
+        self.assertEquals(decode_cursor(cursor), (time, pk), msg="復元できる")
+
+    def test_decode_invalid_cursor(self):
+        with self.assertRaises(InvalidCursorError):
+            decode_cursor("invalid")
+        with self.assertRaises(InvalidCursorError):
+            decode_cursor(encode_cursor(datetime(2021, 4, 1), "not-uuid"))
@@ -17,6 +17,7 @@ from chat.v4.views import (
     rooms_detail_api_view,
     rooms_detail_images_api_view,
     rooms_detail_participants_api_view,
+    rooms_detail_messages_api_view,
     rooms_detail_left_members_api_view,
     rooms_detail_closed_members_api_view,
     private_rooms_api_view,
@@ -68,6 +69,11 @@ urlpatterns = [
         rooms_detail_participants_api_view,
         name="rooms_detail_participants_api",
     ),
+    path(
+        "rooms/<uuid:room_id>/messages/",
+        rooms_detail_messages_api_view,
+        name="rooms_detail_messages_api",
+    ),
     path(
         "rooms/<uuid:room_id>/left-members/",
         rooms_detail_left_members_api_view,
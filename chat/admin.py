@@ -1,6 +1,7 @@
 from django.contrib import admin
 from .models import *
 from django.utils.html import format_html
+from fullfii.db.chat import bump_room_member_versions, invalidate_room_feed
 
 
 @admin.register(RoomV4)
@@ -84,6 +85,12 @@ class RoomV4Admin(admin.ModelAdmin):
     format_is_talking.short_description = "会話中"
     format_is_talking.empty_value_display = "未設定"
 
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # 終了・非活性・メンバー等の変更をフィード・トーク情報のETagへ反映
+        invalidate_room_feed()
+        bump_room_member_versions(form.instance)
+
 
 @admin.register(MessageV4)
 class MessageV4Admin(admin.ModelAdmin):
@@ -138,6 +145,13 @@ class MessageV4Admin(admin.ModelAdmin):
     format_read_participants.admin_order_field = "read_participants"
 
 
+@admin.register(RoomMemberWatermark)
+class RoomMemberWatermarkAdmin(admin.ModelAdmin):
+    list_display = ("member", "room", "last_read_at", "last_stored_at", "unread_count")
+    raw_id_fields = ("room", "member")
+    search_fields = ("member__username",)
+
+
 @admin.register(DefaultRoomImage)
 class DefaultRoomImageAdmin(admin.ModelAdmin):
     list_display = (
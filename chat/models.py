@@ -2,6 +2,7 @@ import uuid
 from django.db import models
 from django.utils import timezone
 from stdimage.models import StdImageField
+from account.models import render_std_image_variations, save_std_image_variants
 from random import choice
 
 
@@ -16,6 +17,10 @@ class RoomV4(models.Model):
         else:
             return f"無名ルーム ({self.owner})"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        save_std_image_variants(self, "image")
+
     def get_upload_to(instance, filename):
         media_dir_1 = str(instance.id)
         return "room_images/{0}/{1}".format(media_dir_1, filename)
@@ -40,7 +45,11 @@ class RoomV4(models.Model):
             "thumbnail": (100, 100, True),
             "medium": (250, 250, True),
         },
+        render_variations=render_std_image_variations,
     )
+    image_variants = models.CharField(
+        verbose_name="描画済みの画像サイズ", max_length=100, null=True, blank=True
+    )  # カンマ区切り. Noneは未記録
     default_image = models.ForeignKey(
         "chat.DefaultRoomImage",
         verbose_name="デフォルトルーム画像",
@@ -82,12 +91,17 @@ class RoomV4(models.Model):
     is_active = models.BooleanField(
         verbose_name="アクティブ状態", default=True
     )  # 全員クローズしたらFalse
+    last_message_seq = models.PositiveIntegerField(
+        verbose_name="最後のメッセージ番号", default=0
+    )  # MessageV4.seqの採番に使用
 
 
 class MessageV4(models.Model):
     class Meta:
         verbose_name = verbose_name_plural = "メッセージ"
         ordering = ["-time"]
+        unique_together = ("room", "seq")
+        indexes = [models.Index(fields=["room", "time"])]
 
     def __str__(self):
         return "{}({})".format(str(self.room), self.time)
@@ -99,6 +113,7 @@ class MessageV4(models.Model):
     sender = models.ForeignKey(
         "account.Account", verbose_name="投稿者", on_delete=models.PROTECT
     )
+    # not used (RoomMemberWatermarkへ移行)
     stored_on_participants = models.ManyToManyField(
         "account.Account",
         verbose_name="保存済み参加者",
@@ -106,6 +121,7 @@ class MessageV4(models.Model):
         symmetrical=False,
         related_name="message_stored_on_participants",
     )
+    # not used (RoomMemberWatermarkへ移行)
     read_participants = models.ManyToManyField(
         "account.Account",
         verbose_name="既読済み参加者",
@@ -116,6 +132,75 @@ class MessageV4(models.Model):
     text = models.TextField(verbose_name="メッセージ内容", max_length=1000, blank=True)
     time = models.DateTimeField(verbose_name="投稿時間", default=timezone.now)
     is_leave_message = models.BooleanField(verbose_name="退室メッセージ", default=False)
+    seq = models.PositiveIntegerField(
+        verbose_name="メッセージ番号", null=True, blank=True
+    )  # ルームごとの連番. 保存時にcreate_messages_with_seqで採番する
+
+
+class RoomMemberWatermark(models.Model):
+    """
+    ルームのメンバーごとの既読・保存済み位置. time <= last_read_atのメッセージを既読,
+    time <= last_stored_atのメッセージを保存済みとする. (未作成・Noneの場合, 全メッセージが未読・未保存)
+    unread_count(未読数)はプッシュ通知のバッジ用に差分で保持する
+    """
+
+    class Meta:
+        verbose_name = verbose_name_plural = "既読・保存済み位置"
+        unique_together = ("room", "member")
+
+    def __str__(self):
+        return "{} ({})".format(self.member, self.room)
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    room = models.ForeignKey(
+        RoomV4,
+        verbose_name="チャットルーム",
+        on_delete=models.CASCADE,
+        related_name="member_watermarks",
+    )
+    member = models.ForeignKey(
+        "account.Account",
+        verbose_name="メンバー",
+        on_delete=models.CASCADE,
+        related_name="room_watermarks",
+    )
+    last_read_at = models.DateTimeField(verbose_name="既読位置", null=True, blank=True)
+    last_stored_at = models.DateTimeField(verbose_name="保存済み位置", null=True, blank=True)
+    # メッセージ作成時に加算, 既読・クローズ時に再計算 (reconcile_unread_countsで修復)
+    unread_count = models.PositiveIntegerField(verbose_name="未読数", default=0)
+
+
+class PrivateRoomInbox(models.Model):
+    """
+    プライベートルーム作成時に, 閲覧可能なユーザ(作成者がまた話したいユーザに登録した人)ごとに書き込む.
+    ブロック・凍結は書き込み時に除外し, ルーム終了・非活性時に削除する.
+    """
+
+    class Meta:
+        verbose_name = verbose_name_plural = "プライベートルーム受信箱"
+        ordering = ["-created_at"]
+        unique_together = ("recipient", "room")
+        indexes = [models.Index(fields=["recipient", "-created_at"])]
+
+    def __str__(self):
+        return "{} <- {}".format(self.recipient, self.room)
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    recipient = models.ForeignKey(
+        "account.Account",
+        verbose_name="受信者",
+        on_delete=models.CASCADE,
+        related_name="private_room_inbox",
+    )
+    room = models.ForeignKey(
+        RoomV4,
+        verbose_name="プライベートルーム",
+        on_delete=models.CASCADE,
+        related_name="inbox_entries",
+    )
+    created_at = models.DateTimeField(
+        verbose_name="作成時間(ルームの作成時間)", default=timezone.now
+    )
 
 
 class DefaultRoomImage(models.Model):
@@ -126,6 +211,10 @@ class DefaultRoomImage(models.Model):
     def __str__(self):
         return f"{self.file_name}"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        save_std_image_variants(self, "image")
+
     def get_upload_to(self, filename):
         media_dir_1 = str(self.id)
         return "default_room_images/{0}/{1}".format(media_dir_1, filename)
@@ -144,7 +233,11 @@ class DefaultRoomImage(models.Model):
             "thumbnail": (100, 100, True),
             "medium": (250, 250, True),
         },
+        render_variations=render_std_image_variations,
     )
+    image_variants = models.CharField(
+        verbose_name="描画済みの画像サイズ", max_length=100, null=True, blank=True
+    )  # カンマ区切り. Noneは未記録
 
 
 class TalkStatus(models.TextChoices):
@@ -0,0 +1,75 @@
+import json
+
+from django.test import TestCase
+
+from account.models import FavoriteUserRelationship, Gender, Job
+from account.tests.factories import AccountFactory
+from account.v4.fast_serializers import serialize_user
+from account.v4.serializers import UserSerializer
+from chat.models import MessageV4
+from chat.tests import factories
+from chat.v4.fast_serializers import serialize_message, serialize_room, serialize_rooms
+from chat.v4.serializers import MessageSerializer, RoomSerializer
+from fullfii.db.account import get_favorite_user_ids
+from fullfii.db.chat import load_rooms
+
+
+def dumps(data):
+    return json.dumps(data, ensure_ascii=False)
+
+
+class TestFastSerializers(TestCase):
+    """DRFのシリアライザと出力が同一であることをテスト"""
+
+    def setUp(self):
+        self.me = AccountFactory()
+        self.users = [
+            AccountFactory(gender=Gender.FEMALE, job=Job.WORKER),
+            AccountFactory(gender=Gender.NOTSET, job=Job.SECRET, username=""),
+            AccountFactory(gender="unknown", job="unknown", is_secret_gender=True),
+        ]
+        self.rooms = [
+            factories.RoomV4Factory(owner=self.users[0], participants=[self.me]),
+            factories.RoomV4Factory(
+                owner=self.me, image=None, participants=self.users[1:]
+            ),
+            factories.RoomV4Factory(
+                owner=self.users[2], left_members=[self.users[0]], is_private=True
+            ),
+        ]
+        FavoriteUserRelationship.objects.create(owner=self.me, favorite_account=self.users[0])
+        FavoriteUserRelationship.objects.create(owner=self.me, favorite_account=self.users[2])
+
+    def test_serialize_user(self):
+        for user in [self.me, *self.users]:
+            self.assertEquals(
+                dumps(serialize_user(user)),
+                dumps(UserSerializer(user).data),
+                msg="UserSerializerと同一",
+            )
+
+    def test_serialize_room(self):
+        rooms = load_rooms([room.id for room in self.rooms])
+        for room in rooms:
+            self.assertEquals(
+                dumps(serialize_room(room)),
+                dumps(RoomSerializer(room).data),
+                msg="contextなしのRoomSerializerと同一",
+            )
+        self.assertEquals(
+            dumps(serialize_rooms(rooms, get_favorite_user_ids(self.me))),
+            dumps(RoomSerializer(rooms, many=True, context={"me": self.me}).data),
+            msg="context付きのRoomSerializerと同一",
+        )
+
+    def test_serialize_message(self):
+        messages = [
+            MessageV4.objects.create(room=self.rooms[0], sender=self.me, text="こんにちは"),
+            MessageV4.objects.create(room=self.rooms[0], sender=self.users[0], text=""),
+        ]
+        for message in messages:
+            self.assertEquals(
+                dumps(serialize_message(message)),
+                dumps(MessageSerializer(message).data),
+                msg="MessageSerializerと同一",
+            )
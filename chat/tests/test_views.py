@@ -0,0 +1,41 @@
+from django.test import TransactionTestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from account.models import Gender
+from account.tests.factories import AccountFactory
+from chat.tests.factories import RoomV4Factory
+from fullfii.lib.cache_store import LocalCacheStore, override_cache_store
+
+
+class TestRoomsAPIView(TransactionTestCase):
+    # invalidate_room_feed()はcommit後に実行されるため, TransactionTestCaseとする
+    URL = "/api/v4/rooms/"
+
+    def test_etag_after_owner_profile_edit(self):
+        with override_cache_store(LocalCacheStore()):
+            owner = AccountFactory(gender=Gender.MALE)
+            viewer = AccountFactory(gender=Gender.MALE)
+            RoomV4Factory(owner=owner, is_active=True, created_at=timezone.now())
+
+            client = APIClient()
+            client.force_authenticate(user=viewer)
+            response = client.get(self.URL)
+            self.assertEquals(response.status_code, 200, msg="HTTPステータス200が返る")
+            etag = response["ETag"]
+            response = client.get(self.URL, HTTP_IF_NONE_MATCH=etag)
+            self.assertEquals(response.status_code, 304, msg="変更がなければ304が返る")
+
+            owner_client = APIClient()
+            owner_client.force_authenticate(user=owner)
+            owner_client.patch("/api/v4/me/", {"introduction": "変更後"}, format="json")
+
+            response = client.get(self.URL, HTTP_IF_NONE_MATCH=etag)
+            self.assertEquals(
+                response.status_code, 200, msg="オーナーのプロフィール変更後は200が返る"
+            )
+            self.assertEquals(
+                response.data["rooms"][0]["owner"]["introduction"],
+                "変更後",
+                msg="変更後のプロフィールが返る",
+            )
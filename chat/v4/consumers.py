@@ -1,21 +1,45 @@
 from fullfii.lib.authSupport import authenticate_jwt
+import asyncio
 import traceback
 import uuid
+from collections import namedtuple
 from asgiref.sync import async_to_sync
 from channels.db import database_sync_to_async
-import json
 from channels.layers import get_channel_layer
+from django.db.models import Q
 from django.utils import timezone
 
 from fullfii.lib.inappropriate_checker import InappropriateChecker, InappropriateType
-from main.v4.consumers import JWTAsyncWebsocketConsumer
+from main.v4.consumers import JWTAsyncWebsocketConsumer, NotificationConsumer
+from account.models import Account, FavoriteUserRelationship
 from chat.models import RoomV4, MessageV4
-from chat.v4.serializers import MessageSerializer, RoomSerializer
-from fullfii.lib.firebase import send_fcm
+from chat.v4.fast_serializers import serialize_message, serialize_room
+from chat.v4.serializers import RoomSerializer
+from fullfii.lib.firebase import enqueue_fcm
+from fullfii.db.message_buffer import get_message_buffer
+from fullfii.db.chat import (
+    bump_user_versions,
+    create_messages_with_seq,
+    get_messages_since_seq,
+    invalidate_room_feed,
+    get_not_stored_messages,
+    mark_message_stored,
+    mark_room_messages_read,
+    mark_room_messages_stored,
+)
+
+
+# ChatConsumerが保持するルームと自分の不変スナップショット. Modelオブジェクトは保持しない.
+# メンバー・終了状態・凍結状態の変更時にsend_room_state_changedで再取得する.
+ChatRoomSnapshot = namedtuple(
+    "ChatRoomSnapshot",
+    ["room_id", "owner_id", "member_ids", "is_end", "me_id", "is_ban"],
+)
 
 
 class ChatConsumer(JWTAsyncWebsocketConsumer):
     groups = ["broadcast"]
+    backlog_chunk_size = 100  # stream_backlog時の1フレームのメッセージ数
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -24,6 +48,9 @@ class ChatConsumer(JWTAsyncWebsocketConsumer):
             if "room_id" in self.scope["url_route"]["kwargs"]
             else ""
         )
+        self.room_snapshot = None
+        self.backlog_task = None
+        self.is_disconnected = False
         self.inappropriate_checker = None
         self.inappropriate_words_csv_path = (
             "fullfii/lib/inappropriate_checker/inappropriate_words.csv"
@@ -33,15 +60,27 @@ class ChatConsumer(JWTAsyncWebsocketConsumer):
     def get_group_name(cls, _id):
         return "room_{}".format(str(_id))
 
+    async def _disconnect(self, close_code):
+        if self.backlog_task is not None:
+            # スレッド側のループはis_disconnectedで中断する
+            self.is_disconnected = True
+            self.backlog_task.cancel()
+        # write-behind有効時, バッファ済みのメッセージを確実に保存する
+        if get_message_buffer() is not None:
+            await self.flush_message_buffer()
+
     async def receive_auth(self, received_data):
         """
-        received_data: {'type': 'auth', 'token': token}
+        received_data: {'type': 'auth', 'token': token, 'since_seq': 10(任意), 'stream_backlog': True(任意)}
+        since_seqを指定した場合, not_stored_messagesはseqがsince_seqより後のメッセージ
+        stream_backlogがTrueの場合, not_stored_messagesは空で, auth送信後にbacklog_chunk, backlog_endで送信する
 
         return {
             'type': 'auth',
             'room_id': room_id,
             'not_stored_messages': [],
             'is_already_ended': False,
+            'last_seq': 12,
         }
         """
 
@@ -64,12 +103,24 @@ class ChatConsumer(JWTAsyncWebsocketConsumer):
             "is_already_ended": False,
         }
 
+        if get_message_buffer() is not None:
+            # このワーカーでバッファ中のメッセージもnot_stored_messagesに含めるため
+            await self.flush_message_buffer()
+
+        since_seq = received_data.get("since_seq")
+        if not isinstance(since_seq, int) or isinstance(since_seq, bool):
+            since_seq = None
+        should_stream_backlog = received_data.get("stream_backlog") is True
+
         room = await self.get_room()
         if room:
             # Messages that you haven't stored yet include in auth send.
-            not_stored_messages_data = await self.get_not_stored_messages_data(me, room)
-            if not_stored_messages_data:
-                auth_response_data["not_stored_messages"] = not_stored_messages_data
+            if not should_stream_backlog:
+                not_stored_messages_data = await self.get_backlog_messages_data(
+                    me, room, since_seq
+                )
+                if not_stored_messages_data:
+                    auth_response_data["not_stored_messages"] = not_stored_messages_data
 
             # If the talk has already ended, notice. (通常、アプリがquit間にトークの開始・終了が行われた時)
             is_already_ended = room.is_end
@@ -77,6 +128,8 @@ class ChatConsumer(JWTAsyncWebsocketConsumer):
                 auth_response_data["is_already_ended"] = is_already_ended
 
             auth_response_data["room"] = await self.get_room_data(room, me)
+            auth_response_data["last_seq"] = room.last_message_seq
+            self.room_snapshot = await self.load_room_snapshot()
 
             # 不適切チェッカー
             self.inappropriate_checker = await self.create_inappropriate_checker(
@@ -94,9 +147,52 @@ class ChatConsumer(JWTAsyncWebsocketConsumer):
             print("room error.")
             return
 
-        await self.send(text_data=json.dumps(auth_response_data))
+        await self.send_json(auth_response_data)
+
+        if room and should_stream_backlog:
+            # 他のフレームの受信を妨げないようタスクで送信する
+            self.backlog_task = asyncio.ensure_future(
+                self.stream_backlog(me, room, since_seq)
+            )
         return True
 
+    async def stream_backlog(self, me, room, since_seq):
+        try:
+            await self.send_backlog_chunks(me, room, since_seq)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            traceback.print_exc()
+
+    @database_sync_to_async
+    def send_backlog_chunks(self, me, room, since_seq):
+        """
+        未保存のメッセージをbacklog_chunk_size件ずつbacklog_chunkで送信し, 最後にbacklog_endを送信する.
+        querysetを.iterator()で読み進めるため, バックログ全体をメモリに載せない
+        """
+        room_id = str(self.room_id)
+        messages = self.get_backlog_messages(me, room, since_seq)
+        chunk = []
+        count = 0
+        for message in messages.iterator(chunk_size=self.backlog_chunk_size):
+            if self.is_disconnected:
+                return
+            chunk.append(serialize_message(message))
+            if len(chunk) >= self.backlog_chunk_size:
+                async_to_sync(self.send_json)(
+                    {"type": "backlog_chunk", "room_id": room_id, "messages": chunk}
+                )
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            async_to_sync(self.send_json)(
+                {"type": "backlog_chunk", "room_id": room_id, "messages": chunk}
+            )
+            count += len(chunk)
+        async_to_sync(self.send_json)(
+            {"type": "backlog_end", "room_id": room_id, "count": count}
+        )
+
     async def _receive(self, received_data):
         received_type = received_data["type"]
 
@@ -106,43 +202,56 @@ class ChatConsumer(JWTAsyncWebsocketConsumer):
                 text = received_data["text"]
                 time = timezone.datetime.now()
 
-                me = await self.get_user(self.me_id)
+                if self.room_snapshot is None:
+                    # auth時にroomが未作成だった場合
+                    self.room_snapshot = await self.load_room_snapshot()
+                if self.room_snapshot is not None and self.room_snapshot.is_end:
+                    # 終了したルームへのchat_messageは送信しない
+                    return
 
                 # 不適切チェック
                 if self.inappropriate_checker is not None:
                     result = await self.check_inappropriate_word(text)
                     # タブーだった場合, 凍結処理
                     if result == InappropriateType.TABOO:
-                        await self.send(
-                            text_data=json.dumps(
-                                {
-                                    "type": "chat_taboo_message",
-                                    "room_id": str(self.room_id),
-                                    "message_id": message_id,
-                                }
-                            )
+                        await self.send_json(
+                            {
+                                "type": "chat_taboo_message",
+                                "room_id": str(self.room_id),
+                                "message_id": message_id,
+                            }
                         )
-                        await self.ban_me(me)
+                        if self.room_snapshot is None or not self.room_snapshot.is_ban:
+                            await self.ban_me()
                         return
 
+                # seqを採番するため保存後に送信する (write-behind時はseqなし)
+                message = await self.create_message(message_id, text, time)
+                if message is None:
+                    # chat_message送信失敗
+                    return
                 await self.channel_layer.group_send(
                     self.group_name,
                     {
                         "type": "chat_message",
-                        "message_id": message_id,
-                        "text": text,
-                        "sender_id": str(me.id),
-                        "time": time.strftime("%Y/%m/%d %H:%M:%S"),
+                        "frame": self.encode_chat_message_frame(
+                            self.room_id,
+                            message_id,
+                            text,
+                            self.me_id,
+                            time,
+                            message.seq,
+                        ),
                     },
                 )
-                await self.create_message(message_id, text, time, me)
 
-                room = await self.get_room()
-                if room:
+                if self.room_snapshot is not None:
                     # send fcm(SEND_MESSAGE)
-                    receiver_list = await self.get_receiver_list(sender=me, room=room)
+                    me, receiver_list = await self.get_sender_and_receiver_list(
+                        self.room_snapshot
+                    )
                     for receiver in receiver_list:
-                        await send_fcm(
+                        enqueue_fcm(
                             receiver,
                             {
                                 "type": "SEND_MESSAGE_V4",
@@ -157,56 +266,36 @@ class ChatConsumer(JWTAsyncWebsocketConsumer):
         elif received_type == "store":
             if "message_id" in received_data:
                 message_id = received_data["message_id"]
-
-                me = await self.get_user(self.me_id)
-                await self.turn_on_message_stored(me, message_id=message_id)
+                await self.turn_on_message_stored(self.me_id, message_id=message_id)
             else:
                 # store 失敗
                 pass
 
         elif received_type == "store_by_room":
-            me = await self.get_user(self.me_id)
-            await self.turn_on_message_stored(me, room_id=self.room_id)
+            await self.turn_on_message_stored(self.me_id, room_id=self.room_id)
 
         # フロントで既読処理が走った際に送信される
         elif received_type == "read":
-            me = await self.get_user(self.me_id)
-            await self.turn_on_read_all_messages(me=me, room_id=self.room_id)
+            await self.turn_on_read_all_messages(self.me_id, room_id=self.room_id)
 
+    # group eventのフレームは送信側で1回だけエンコードし, 受信側はそのまま送信する
     async def chat_message(self, event):
         try:
-            message_id = event["message_id"]
-            text = event["text"]
-            sender_id = event["sender_id"]
-            time = event["time"]
+            await self.send(text_data=event["frame"])
+        except Exception as e:
+            traceback.print_exc()
 
-            await self.send(
-                text_data=json.dumps(
-                    {
-                        "type": "chat_message",
-                        "room_id": str(self.room_id),
-                        # serializerを参考に ↓
-                        "message": {
-                            "id": message_id,
-                            "text": text,
-                            "sender_id": sender_id,
-                            "time": time,
-                        },
-                    }
-                )
-            )
+    async def room_state_changed(self, event):
+        try:
+            self.room_snapshot = await self.load_room_snapshot()
         except Exception as e:
             traceback.print_exc()
 
     async def end_talk(self, event):
         try:
-            data = {"type": "end_talk"}
-            room = await self.get_room()
-            me = await self.get_user(self.me_id)
-            room_data = await self.get_room_data(room, me)
-            appended_data = {"room": room_data}
-            data.update(appended_data)
-            await self.send(text_data=json.dumps(data))
+            # メンバーごとに異なるのはadded_favorite_user_idsのみ
+            frame = event["member_frames"].get(str(self.me_id), event["frame"])
+            await self.send(text_data=frame)
         except Exception as e:
             traceback.print_exc()
 
@@ -221,9 +310,39 @@ class ChatConsumer(JWTAsyncWebsocketConsumer):
             return
 
     @database_sync_to_async
-    def ban_me(self, me):
+    def load_room_snapshot(self):
+        room = (
+            RoomV4.objects.filter(id=self.room_id)
+            .only("id", "owner_id", "is_end")
+            .first()
+        )
+        if room is None:
+            return
+        participant_ids = room.participants.values_list("id", flat=True)
+        is_ban = (
+            Account.objects.filter(id=self.me_id)
+            .values_list("is_ban", flat=True)
+            .first()
+        )
+        return ChatRoomSnapshot(
+            room_id=room.id,
+            owner_id=room.owner_id,
+            member_ids=frozenset([room.owner_id, *participant_ids]),
+            is_end=room.is_end,
+            me_id=self.me_id,
+            is_ban=bool(is_ban),
+        )
+
+    @database_sync_to_async
+    def ban_me(self):
+        me = Account.objects.get(id=self.me_id)
         me.is_ban = True
         me.save()
+        NotificationConsumer.send_feed_deltas_of_owner("updated", me)
+        self.send_room_state_changed_of_member(me)
+        # inboxは削除しない (取得時に凍結ユーザのルームを除外するため, 凍結解除時にそのまま表示される)
+        invalidate_room_feed()
+        bump_user_versions(me.id)
 
     @database_sync_to_async
     def create_inappropriate_checker(self, me, room):
@@ -242,89 +361,183 @@ class ChatConsumer(JWTAsyncWebsocketConsumer):
         return RoomSerializer(room, context={"me": me}).data
 
     @database_sync_to_async
-    def get_receiver_list(self, sender, room):
-        receiver_list = []
-
-        # owner
-        if sender.id != room.owner.id:
-            receiver_list.append(room.owner)
+    def get_sender_and_receiver_list(self, room_snapshot):
+        """
+        自分とメンバー(owner, participants)を1クエリで取得し, (自分, 自分以外のメンバー)を返す
+        """
+        members = Account.objects.filter(id__in=room_snapshot.member_ids | {self.me_id})
+        me = next((member for member in members if member.id == self.me_id), None)
+        if me is None:
+            return None, []
+        receiver_list = [member for member in members if member.id != self.me_id]
+        return me, receiver_list
 
-        # participants
-        for participant in room.participants.all():
-            if sender.id != participant.id:
-                receiver_list.append(participant)
+    async def create_message(self, message_id, text, time):
+        """
+        不正なmessage_idの場合, 保存に失敗した場合None (保存できたseqのみ送信するため)
+        """
+        try:
+            message_id = uuid.UUID(str(message_id))
+        except ValueError:
+            return
+        message = MessageV4(
+            id=message_id,
+            room_id=self.room_id,
+            sender_id=self.me_id,
+            text=text,
+            time=time,
+        )
+        message_buffer = get_message_buffer()
+        if message_buffer is not None:
+            # write-behind: スレッドを経由せずバッファへ追加
+            message_buffer.add(message)
+        elif not await self.save_message(message):
+            return
+        return message
 
-        return receiver_list
+    @database_sync_to_async
+    def save_message(self, message):
+        try:
+            # message_idが他のルームで使用されている場合は保存されない
+            return bool(create_messages_with_seq([message]))
+        except Exception as e:
+            traceback.print_exc()
+            return False
 
     @database_sync_to_async
-    def create_message(self, message_id, text, time, me):
+    def flush_message_buffer(self):
         try:
-            room = RoomV4.objects.get(id=self.room_id)
-            MessageV4.objects.create(
-                id=message_id,
-                room=room,
-                sender=me,
-                text=text,
-                time=time,
-            )
+            get_message_buffer().flush()
         except Exception as e:
             traceback.print_exc()
 
     @database_sync_to_async
-    def turn_on_read_all_messages(self, me, room_id):
+    def turn_on_read_all_messages(self, me_id, room_id):
         """
-        message.read_participants更新
+        既読位置(RoomMemberWatermark.last_read_at)更新
         """
         try:
-            messages = MessageV4.objects.filter(room__id=room_id).exclude(
-                read_participants=me.id
-            )
-            for message in messages:
-                message.read_participants.add(me)
+            mark_room_messages_read(me_id, room_id)
         except:
             traceback.print_exc()
 
     @database_sync_to_async
-    def turn_on_message_stored(self, me, message_id=None, room_id=None):
+    def turn_on_message_stored(self, me_id, message_id=None, room_id=None):
         """
-        message.stored_on_participants更新
-        引数message_idを指定した場合、message単位で更新
+        保存済み位置(RoomMemberWatermark.last_stored_at)更新
+        引数message_idを指定した場合、messageの時刻まで更新
         引数room_idを指定した場合、room単位で更新
         """
         try:
             if message_id:  # for one message
-                message = MessageV4.objects.get(id=message_id)
-                message.stored_on_participants.add(me)
+                mark_message_stored(me_id, message_id)
 
             elif room_id:  # for all messages in the room
-                messages = MessageV4.objects.filter(room__id=room_id).exclude(
-                    stored_on_participants=me.id
-                )
-                for message in messages:
-                    message.stored_on_participants.add(me)
+                mark_room_messages_stored(me_id, room_id)
         except Exception as e:
             traceback.print_exc()
 
+    def get_backlog_messages(self, me, room, since_seq=None):
+        """since_seq指定時はseqがsince_seqより後, それ以外は未保存のメッセージ"""
+        if since_seq is not None:
+            return get_messages_since_seq(room, since_seq)
+        return get_not_stored_messages(me, room)
+
     @database_sync_to_async
-    def get_not_stored_messages_data(self, me, room):
+    def get_backlog_messages_data(self, me, room, since_seq=None):
         try:
-            messages = (
-                MessageV4.objects.filter(room=room)
-                .exclude(stored_on_participants=me.id)
-                .order_by("time")
-            )
-            return MessageSerializer(messages, many=True).data
+            messages = self.get_backlog_messages(me, room, since_seq)
+            return [serialize_message(message) for message in messages]
         except Exception as e:
             traceback.print_exc()
 
     @classmethod
-    def send_end_talk(cls, room_id):
+    def encode_chat_message_frame(
+        cls, room_id, message_id, text, sender_id, time, seq=None
+    ):
+        return cls.encode_json(
+            {
+                "type": "chat_message",
+                "room_id": str(room_id),
+                # serializerを参考に ↓
+                "message": {
+                    "id": str(message_id),
+                    "text": text,
+                    "sender_id": str(sender_id),
+                    "time": time.strftime("%Y/%m/%d %H:%M:%S"),
+                    "seq": seq,
+                },
+            }
+        )
+
+    @classmethod
+    def encode_end_talk_frames(cls, room):
+        """
+        end_talkのフレーム. ルームのデータは1回だけエンコードし, メンバーごとのadded_favorite_user_ids
+        (RoomSerializerの最後のフィールド)のみ末尾に付け足す.
+        return (メンバー以外へのフレーム, {member_id: フレーム})
+        """
+        room_data = serialize_room(room)
+        del room_data["added_favorite_user_ids"]
+        frame_prefix = '{"type":"end_talk","room":' + cls.encode_json(room_data)[:-1]
+
+        def encode_frame(favorite_user_ids):
+            return (
+                frame_prefix
+                + ',"added_favorite_user_ids":'
+                + cls.encode_json(favorite_user_ids)
+                + "}}"
+            )
+
+        member_ids = {room.owner_id} | {
+            member.id for member in [*room.participants.all(), *room.left_members.all()]
+        }
+        member_ids.discard(None)
+        favorite_user_ids = {member_id: [] for member_id in member_ids}
+        for owner_id, favorite_account_id in (
+            FavoriteUserRelationship.objects.filter(
+                owner_id__in=member_ids, favorite_account_id__in=member_ids
+            )
+            .order_by("-created_at")
+            .values_list("owner_id", "favorite_account_id")
+        ):
+            favorite_user_ids[owner_id].append(str(favorite_account_id))
+
+        return encode_frame([]), {
+            str(member_id): encode_frame(favorite_user_ids[member_id])
+            for member_id in member_ids
+        }
+
+    @classmethod
+    def send_room_state_changed(cls, room_id):
+        """メンバー・終了状態の変更をルームのconsumerへ通知し, スナップショットを再取得させる"""
         group_name = cls.get_group_name(room_id)
         channel_layer = get_channel_layer()
+        async_to_sync(channel_layer.group_send)(
+            group_name,
+            {"type": "room_state_changed"},
+        )
+
+    @classmethod
+    def send_room_state_changed_of_member(cls, account):
+        """凍結状態の変更を, accountがメンバーのルーム(作成・参加中)のconsumerへ通知する"""
+        room_ids = RoomV4.objects.filter(
+            Q(owner=account) | Q(participants=account), is_active=True
+        ).values_list("id", flat=True)
+        for room_id in set(room_ids):
+            cls.send_room_state_changed(room_id)
+
+    @classmethod
+    def send_end_talk(cls, room):
+        frame, member_frames = cls.encode_end_talk_frames(room)
+        group_name = cls.get_group_name(room.id)
+        channel_layer = get_channel_layer()
         async_to_sync(channel_layer.group_send)(
             group_name,
             {
                 "type": "end_talk",
+                "frame": frame,
+                "member_frames": member_frames,
             },
         )
 
@@ -334,25 +547,24 @@ class ChatConsumer(JWTAsyncWebsocketConsumer):
         time = timezone.datetime.now()
 
         try:
-            room = RoomV4.objects.get(id=room_id)
-            MessageV4.objects.create(
+            message = MessageV4(
                 id=message_id,
-                room=room,
+                room_id=room_id,
                 sender=sender,
                 text=text,
                 time=time,
                 is_leave_message=True,
             )
+            create_messages_with_seq([message])
             group_name = cls.get_group_name(room_id)
             channel_layer = get_channel_layer()
             async_to_sync(channel_layer.group_send)(
                 group_name,
                 {
                     "type": "chat_message",
-                    "message_id": str(message_id),
-                    "text": text,
-                    "sender_id": str(sender.id),
-                    "time": time.strftime("%Y/%m/%d %H:%M:%S"),
+                    "frame": cls.encode_chat_message_frame(
+                        room_id, message_id, text, sender.id, time, message.seq
+                    ),
                 },
             )
         except Exception as e:
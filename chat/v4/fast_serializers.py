@@ -0,0 +1,62 @@
+from account.v4.fast_serializers import build_media_url, format_datetime, serialize_user
+from fullfii.db.account import exists_std_images
+
+
+### fast serializers ###
+# 読み取り専用. RoomSerializer, MessageSerializerと同一の出力をDRFのフィールド処理を経由せずdictで生成する.
+# owner, participants, left_membersはwith_room_relationsで取得済みであること.
+def get_room_image_url(room):
+    image = room.image if room.image else room.default_image.image
+    if exists_std_images(image):
+        return build_media_url(image.medium.url)
+    return build_media_url(image.url)
+
+
+def serialize_room(room, favorite_user_ids=None):
+    """
+    RoomSerializer(room, context=...).dataと同一.
+    favorite_user_ids: context["me"]のまた話したいユーザid(新しい順). Noneの場合contextなし
+    """
+    participants = room.participants.all()
+    if favorite_user_ids is None:
+        added_favorite_user_ids = []
+    else:
+        member_ids = {room.owner_id} | {participant.id for participant in participants}
+        added_favorite_user_ids = [
+            str(favorite_user_id)
+            for favorite_user_id in favorite_user_ids
+            if favorite_user_id in member_ids
+        ]
+
+    return {
+        "id": str(room.id),
+        "name": room.name,
+        "image": get_room_image_url(room),
+        "owner": serialize_user(room.owner),
+        "participants": [serialize_user(participant) for participant in participants],
+        "left_members": [
+            serialize_user(left_member) for left_member in room.left_members.all()
+        ],
+        "max_num_participants": room.max_num_participants,
+        "is_exclude_different_gender": room.is_exclude_different_gender,
+        "is_private": room.is_private,
+        "created_at": format_datetime(room.created_at),
+        "is_end": room.is_end,
+        "is_active": room.is_active,
+        "added_favorite_user_ids": added_favorite_user_ids,
+    }
+
+
+def serialize_rooms(rooms, favorite_user_ids=None):
+    return [serialize_room(room, favorite_user_ids) for room in rooms]
+
+
+def serialize_message(message):
+    """MessageSerializer(message).dataと同一. senderは参照しない"""
+    return {
+        "id": str(message.id),
+        "text": message.text,
+        "sender_id": str(message.sender_id),
+        "time": format_datetime(message.time),
+        "seq": message.seq,
+    }
@@ -3,7 +3,7 @@ from rest_framework import serializers
 from account.v4.serializers import UserSerializer
 from chat.models import MessageV4, RoomV4
 from account.models import Account
-from fullfii.db.account import exists_std_images
+from fullfii.db.account import exists_std_images, get_favorite_user_ids
 from fullfii.lib.constants import BASE_URL
 
 
@@ -61,33 +61,25 @@ class RoomSerializer(serializers.ModelSerializer):
         if obj.created_at:
             return obj.created_at.strftime("%Y/%m/%d %H:%M:%S")
 
+    def get_favorite_user_ids(self):
+        """
+        meのまた話したいユーザid(新しい順). 1回のシリアライズ(context)につき1クエリ
+        """
+        if "favorite_user_ids" not in self.context:
+            self.context["favorite_user_ids"] = get_favorite_user_ids(self.context["me"])
+        return self.context["favorite_user_ids"]
+
     def get_added_favorite_user_ids(self, obj):
         if "me" in self.context:
-            favorite_user_relationship = (
-                self.context["me"]
-                .owner_favorite_user_relationship.all()
-                .order_by("-created_at")
-            )
-            favorite_users_ids = favorite_user_relationship.values_list(
-                "favorite_account", flat=True
-            )
-            # このルームに該当するfavorite usersをフィルター
-            target_favorite_users_ids = list(
-                filter(
-                    lambda favorite_user_id: favorite_user_id == obj.owner.id
-                    or favorite_user_id
-                    in obj.participants.values_list("id", flat=True),
-                    list(favorite_users_ids),
-                )
-            )
-
-            # UUIDオブジェクトをstrに変換
-            return list(
-                map(
-                    lambda favorite_user_id: str(favorite_user_id),
-                    target_favorite_users_ids,
-                )
-            )
+            # このルームに該当するfavorite usersをフィルター (participantsはprefetch済みであればクエリなし)
+            member_ids = {obj.owner_id} | {
+                participant.id for participant in obj.participants.all()
+            }
+            return [
+                str(favorite_user_id)
+                for favorite_user_id in self.get_favorite_user_ids()
+                if favorite_user_id in member_ids
+            ]
         else:  # 自身が直接関係しないルーム
             return []
 
@@ -105,7 +97,7 @@ class RoomSerializer(serializers.ModelSerializer):
 class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = MessageV4
-        fields = ("id", "text", "sender_id", "time")
+        fields = ("id", "text", "sender_id", "time", "seq")
 
     sender_id = serializers.SerializerMethodField()
     time = serializers.SerializerMethodField()
@@ -1,19 +1,38 @@
-from asgiref.sync import async_to_sync
 from drf_yasg.utils import swagger_auto_schema
 from account.models_ex import AccountEx
 from fullfii.lib.constants import api_class
-from fullfii.lib.firebase import send_fcm
+from fullfii.lib.firebase import enqueue_fcm
 from main.v4.consumers import NotificationConsumer
-from account.models import Account, Gender
-from django.db.models import Q
+from account.models import Account
 from rest_framework import views, status
 from rest_framework.generics import get_object_or_404
 from rest_framework.response import Response
 from rest_framework.parsers import MultiPartParser
 from chat.models import RoomV4
+from chat.v4.fast_serializers import serialize_message, serialize_rooms
 from chat.v4.serializers import RoomSerializer
+from fullfii.db.account import get_favorite_user_ids
 from chat.v4.consumers import ChatConsumer
-from fullfii.db.chat import get_created_rooms, get_participating_rooms
+from fullfii.db.chat import (
+    FeedViewerExclusion,
+    bump_room_member_versions,
+    bump_user_versions,
+    close_room_for_member,
+    fan_out_private_room,
+    get_created_rooms,
+    get_feed_generation,
+    get_participating_rooms,
+    get_private_room_ids,
+    get_room_message_history,
+    get_room_feed_engine,
+    get_room_feed_payloads,
+    get_user_version,
+    invalidate_room_feed,
+    remove_private_room_inbox,
+    with_room_relations,
+)
+from fullfii.lib.etag import build_etag, is_not_modified, not_modified_response
+from fullfii.lib.pagination import InvalidCursorError
 
 
 class TalkInfoAPIView(views.APIView):
@@ -23,22 +42,26 @@ class TalkInfoAPIView(views.APIView):
         tags=[api_class.API_CLS_ME],
     )
     def get(self, request, *args, **kwargs):
-        created_rooms = get_created_rooms(request.user)
-        created_rooms_serializer = RoomSerializer(
-            created_rooms, many=True, context={"me": request.user}
-        )
-
-        participating_rooms = get_participating_rooms(request.user)
-        participating_rooms_serializer = RoomSerializer(
-            participating_rooms, many=True, context={"me": request.user}
+        etag = build_etag("talk_info", get_user_version(request.user.id))
+        if is_not_modified(request, etag):
+            return not_modified_response(etag)
+
+        # また話したいユーザidを作成ルーム・参加ルームで共有する
+        favorite_user_ids = get_favorite_user_ids(request.user)
+        created_rooms = with_room_relations(get_created_rooms(request.user))
+        participating_rooms = with_room_relations(
+            get_participating_rooms(request.user)
         )
 
         return Response(
             {
-                "created_rooms": created_rooms_serializer.data,
-                "participating_rooms": participating_rooms_serializer.data,
+                "created_rooms": serialize_rooms(created_rooms, favorite_user_ids),
+                "participating_rooms": serialize_rooms(
+                    participating_rooms, favorite_user_ids
+                ),
             },
             status=status.HTTP_200_OK,
+            headers={"ETag": etag},
         )
 
 
@@ -56,85 +79,42 @@ class RoomsAPIView(views.APIView):
     def get(self, request, *args, **kwargs):
         """
         10単位でroomを取得. クエリパラメータ"page"でページ指定.
+        クエリパラメータ"cursor"を指定した場合(空文字で先頭), (created_at, id)のkeyset paginationを行い"next_cursor"を返す.
         """
+        cursor = self.request.GET.get("cursor")
         _page = self.request.GET.get("page")
         page = int(_page) if _page is not None and _page.isdecimal() else 1
 
-        rooms = RoomV4.objects.filter(
-            is_active=True,
-            is_end=False,
-            owner__is_active=True,
-        ).exclude(
-            Q(owner=request.user)
-            | Q(participants=request.user)
-            | Q(id__in=request.user.hidden_rooms.all())
-            | Q(id__in=request.user.blocked_rooms.all())
+        # snapshotを読み込む前に確認する
+        etag = build_etag(
+            "rooms",
+            get_feed_generation(),
+            get_user_version(request.user.id),
+            request.META.get("QUERY_STRING", ""),
         )
-
-        # my gender == 設定済み
-        if request.user.gender != Gender.NOTSET and not request.user.is_secret_gender:
-            # 異性非表示設定 & オーナー性別設定済 & オーナーと性別が異なる : 除外 (相手が異性非表示設定を設定していた場合, 同性別時のみ表示)
-            rooms = rooms.filter(
-                Q(is_exclude_different_gender=False)
-                | Q(owner__is_secret_gender=True)
-                | Q(owner__gender=Gender.NOTSET)
-                | Q(owner__gender=request.user.gender)
-            )
-        # my gender == 未設定 or 秘密
-        else:
-            # 異性非表示設定 & オーナー性別設定済 : 除外 (相手が異性非表示設定を設定していた場合, 無条件で非表示)
-            rooms = rooms.filter(
-                Q(is_exclude_different_gender=False)
-                | Q(owner__is_secret_gender=True)
-                | Q(owner__gender=Gender.NOTSET)
-            )
-
-        # 自分と話しているユーザは非表示
-        talking_member_ids = []
-        created_rooms = get_created_rooms(request.user)
-        for created_room in created_rooms:
-            talking_member_ids += created_room.participants.values_list("id", flat=True)
-        participating_rooms = get_participating_rooms(request.user)
-        talking_member_ids += [
-            participating_room.owner.id for participating_room in participating_rooms
-        ]
-        rooms = rooms.exclude(owner__in=talking_member_ids)
-
-        # 凍結されていたら, 女性は表示しない
-        if request.user.is_ban:
-            rooms = rooms.exclude(
-                owner__gender=Gender.FEMALE, owner__is_secret_gender=False
+        if is_not_modified(request, etag):
+            return not_modified_response(etag)
+
+        # 性別・凍結などのルールはセグメント単位で, 非表示・ブロック・会話中などはメモリ上で除外
+        engine = get_room_feed_engine()
+
+        exclusion = FeedViewerExclusion.create(request.user)
+        try:
+            id_list, has_more, next_cursor = engine.get_visible_room_ids(
+                request.user,
+                exclusion,
+                self.paginate_by,
+                offset=0 if cursor is not None else self.paginate_by * (page - 1),
+                cursor=cursor,
             )
+        except InvalidCursorError:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+        rooms_data = get_room_feed_payloads(id_list)  # TODO: context指定するべきか
 
-        # 女性の場合, 凍結ユーザは表示されない
-        if (
-            request.user.gender == Gender.FEMALE
-            and request.user.is_secret_gender == False
-        ):
-            rooms = rooms.exclude(owner__is_ban=True)
-
-        # ブロックしているユーザ, ブロックされているユーザを表示しない
-        rooms = rooms.exclude(
-            Q(owner__in=request.user.blocked_accounts.all())
-            | Q(owner__in=request.user.block_me_accounts.all())
-        )
-
-        # プライベートルームはroomsに含めない
-        rooms = rooms.exclude(is_private=True)
-
-        # to create id_list will be faster
-        id_list = list(
-            rooms[self.paginate_by * (page - 1) : self.paginate_by * page].values_list(
-                "id", flat=True
-            )
-        )
-        rooms = [rooms.get(id=pk) for pk in id_list]
-
-        serializer = RoomSerializer(rooms, many=True)  # TODO: context指定するべきか
-        return Response(
-            {"rooms": serializer.data, "has_more": not (len(rooms) < self.paginate_by)},
-            status.HTTP_200_OK,
-        )
+        response_data = {"rooms": rooms_data, "has_more": has_more}
+        if cursor is not None:
+            response_data["next_cursor"] = next_cursor
+        return Response(response_data, status.HTTP_200_OK, headers={"ETag": etag})
 
     @swagger_auto_schema(
         operation_summary="ルームの登録",
@@ -161,30 +141,26 @@ class RoomsAPIView(views.APIView):
         post_data = {"owner_id": request.user.id, **request.data}
         room_serializer = RoomSerializer(data=post_data)
         if room_serializer.is_valid():
-            room_serializer.save()
+            room = room_serializer.save()
             room_data = room_serializer.data
-
-            # プライベートルーム作成時通知
-            if not request.user.is_ban and room_data["is_private"]:
-                favorite_user_ids = (
-                    request.user.owner_favorite_user_relationship.all().values_list(
-                        "favorite_account", flat=True
+            invalidate_room_feed()
+            bump_user_versions(request.user.id)
+
+            # プライベートルーム作成時, inboxへ書き込み通知 (凍結・ブロックしていたりされていた場合, 書き込まない)
+            recipient_ids = fan_out_private_room(room)
+            # フィード購読中のユーザへ差分を送信
+            NotificationConsumer.send_feed_delta(
+                "added", room, recipient_ids=recipient_ids
+            )
+            if room.is_private:
+                for receiver in Account.objects.filter(id__in=recipient_ids):
+                    enqueue_fcm(
+                        receiver,
+                        {
+                            "type": "CREATE_PRIVATE_ROOM",
+                            "sender": request.user,
+                        },
                     )
-                )
-                favorite_users = Account.objects.filter(id__in=favorite_user_ids)
-                for receiver in favorite_users:
-                    # ブロックしていたりされていた場合, 通知しない
-                    if (
-                        not request.user in receiver.blocked_accounts.all()
-                        and not request.user in receiver.block_me_accounts.all()
-                    ):
-                        async_to_sync(send_fcm)(
-                            receiver,
-                            {
-                                "type": "CREATE_PRIVATE_ROOM",
-                                "sender": request.user,
-                            },
-                        )
 
             return Response(data=room_data, status=status.HTTP_201_CREATED)
         else:
@@ -229,7 +205,22 @@ class RoomsDetailAPIView(views.APIView):
 
         room_serializer = RoomSerializer(instance=room, data=request.data, partial=True)
         if room_serializer.is_valid():
-            room_serializer.save()
+            # プライベート設定が変更される場合, 変更前のフィードから削除
+            if (
+                room_serializer.validated_data.get("is_private", room.is_private)
+                != room.is_private
+            ):
+                NotificationConsumer.send_feed_delta("removed", room)
+
+            room = room_serializer.save()
+            # プライベート設定の変更をinboxへ反映
+            if room.is_private:
+                fan_out_private_room(room)
+            else:
+                remove_private_room_inbox(room=room)
+            invalidate_room_feed()
+            bump_room_member_versions(room)
+            NotificationConsumer.send_feed_delta("updated", room)
             return Response(data=room_serializer.data, status=status.HTTP_200_OK)
         else:
             return Response(
@@ -264,7 +255,7 @@ class RoomsDetailAPIView(views.APIView):
         RoomsDetailLeftMembersAPIView.check_and_end_room(room)
 
         # close room
-        room.closed_members.add(request.user.id)
+        close_room_for_member(room, request.user.id)
         RoomsDetailClosedMembersAPIView.check_and_deactive_room(room)
 
         return Response(status=status.HTTP_204_NO_CONTENT)
@@ -294,6 +285,9 @@ class RoomsDetailImagesAPIView(views.APIView):
         room_serializer = RoomSerializer(instance=room, data=request_data, partial=True)
         if room_serializer.is_valid():
             room_serializer.save()
+            invalidate_room_feed()
+            bump_room_member_versions(room)
+            NotificationConsumer.send_feed_delta("updated", room)
             return Response(
                 data=RoomSerializer(room, context={"me": request.user}).data,
                 status=status.HTTP_200_OK,
@@ -404,6 +398,11 @@ class RoomsDetailParticipantsAPIView(views.APIView):
 
         room.participants.add(account_id)
         room.save()
+        ChatConsumer.send_room_state_changed(room.id)
+        invalidate_room_feed()
+        bump_room_member_versions(room)
+        if room.participants.count() >= room.max_num_participants:
+            NotificationConsumer.send_feed_delta("full", room)
         room_data = RoomSerializer(room, context={"me": request.user}).data
 
         # ownerへSOMEONE_PARTICIPATED通知
@@ -420,6 +419,58 @@ class RoomsDetailParticipantsAPIView(views.APIView):
 rooms_detail_participants_api_view = RoomsDetailParticipantsAPIView.as_view()
 
 
+class RoomsDetailMessagesAPIView(views.APIView):
+    paginate_by = 30
+    max_paginate_by = 100
+
+    @swagger_auto_schema(
+        operation_summary="ルームのメッセージ履歴の取得",
+        operation_id="rooms_detail_messages_GET",
+        tags=[api_class.API_CLS_ROOM],
+    )
+    def get(self, request, *args, **kwargs):
+        """
+        roomのメッセージを新しい順に"limit"件(既定30, 最大100)取得 (roomのメンバーのみ).
+        クエリパラメータ"before"に前回の"next_cursor"を指定すると, それより古いメッセージを取得する.
+        messagesはページ内で時系列順.
+        """
+        room_id = self.kwargs.get("room_id")
+        room = get_object_or_404(RoomV4, id=room_id)
+
+        validate_result_member_id = RoomsDetailLeftMembersAPIView.validate_member_id(
+            request.user.id, room
+        )
+        if validate_result_member_id is not None:
+            return validate_result_member_id
+
+        cursor = self.request.GET.get("before")
+        _limit = self.request.GET.get("limit")
+        limit = (
+            min(max(int(_limit), 1), self.max_paginate_by)
+            if _limit is not None and _limit.isdecimal()
+            else self.paginate_by
+        )
+
+        try:
+            messages, has_more, next_cursor = get_room_message_history(
+                room, cursor, limit
+            )
+        except InvalidCursorError:
+            return Response(status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(
+            {
+                "messages": [serialize_message(message) for message in messages],
+                "has_more": has_more,
+                "next_cursor": next_cursor,
+            },
+            status=status.HTTP_200_OK,
+        )
+
+
+rooms_detail_messages_api_view = RoomsDetailMessagesAPIView.as_view()
+
+
 class RoomsDetailLeftMembersAPIView(views.APIView):
     @classmethod
     def validate_member_id(cls, _member_id, _room):
@@ -441,8 +492,14 @@ class RoomsDetailLeftMembersAPIView(views.APIView):
             _room.is_end = True
             # メンバー全員にend chat通知
             if _room.participants.count() > 0:
-                ChatConsumer.send_end_talk(_room.id)
+                ChatConsumer.send_end_talk(_room)
+            # フィード購読中のユーザへ差分を送信
+            NotificationConsumer.send_feed_delta("removed", _room)
         _room.save()
+        ChatConsumer.send_room_state_changed(_room.id)
+        remove_private_room_inbox(room=_room)
+        invalidate_room_feed()
+        bump_room_member_versions(_room)
 
     @swagger_auto_schema(
         operation_summary="メンバー(作成者含む)のroomからの退室",
@@ -502,7 +559,12 @@ class RoomsDetailClosedMembersAPIView(views.APIView):
         if _room.closed_members.count() == _room.participants.count() + 1:  # 1: 作成者数
             # ルーム非活性
             _room.is_active = False
+            NotificationConsumer.send_feed_delta("removed", _room)
+            remove_private_room_inbox(room=_room)
         _room.save()
+        ChatConsumer.send_room_state_changed(_room.id)
+        invalidate_room_feed()
+        bump_room_member_versions(_room)
 
     @swagger_auto_schema(
         operation_summary="メンバー(作成者含む)のroomのクローズ",
@@ -534,7 +596,7 @@ class RoomsDetailClosedMembersAPIView(views.APIView):
             # validation error member_id
             return validate_result_member_id
 
-        room.closed_members.add(account_id)
+        close_room_for_member(room, account_id)
         RoomsDetailClosedMembersAPIView.check_and_deactive_room(room)
 
         account = get_object_or_404(Account, id=account_id)
@@ -558,49 +620,32 @@ class PrivateRoomsAPIView(views.APIView):
         _page = self.request.GET.get("page")
         page = int(_page) if _page is not None and _page.isdecimal() else 1
 
-        # 自分と話したいと思ってくれているユーザ
-        private_user_ids = (
-            request.user.favorite_account_favorite_user_relationship.all().values_list(
-                "owner", flat=True
-            )
+        etag = build_etag(
+            "private_rooms",
+            get_feed_generation(),  # ルームの変更
+            get_user_version(request.user.id),  # inbox・非表示・ブロック等の変更
+            request.META.get("QUERY_STRING", ""),
         )
-        private_rooms = RoomV4.objects.filter(
-            owner__in=private_user_ids,
-            is_private=True,
-            is_active=True,
-            is_end=False,
-            owner__is_active=True,
-        ).exclude(
-            Q(owner=request.user)
-            | Q(participants=request.user)
-            | Q(id__in=request.user.hidden_rooms.all())
-            | Q(id__in=request.user.blocked_rooms.all())
-        )
-
-        # 凍結されているユーザは表示しない
-        private_rooms = private_rooms.exclude(owner__is_ban=True)
-
-        # ブロックしているユーザ, ブロックされているユーザを表示しない
-        private_rooms = private_rooms.exclude(
-            Q(owner__in=request.user.blocked_accounts.all())
-            | Q(owner__in=request.user.block_me_accounts.all())
-        )
-
-        # to create id_list will be faster
-        id_list = list(
-            private_rooms[
-                self.paginate_by * (page - 1) : self.paginate_by * page
-            ].values_list("id", flat=True)
+        if is_not_modified(request, etag):
+            return not_modified_response(etag)
+
+        # 自分と話したいと思ってくれているユーザのプライベートルーム (作成時にinboxへ書き込み済み)
+        # 非表示・ブロックルーム, 参加中ルーム, ブロック関係はメモリ上で除外 (会話中のユーザは除外しない)
+        id_list, has_more = get_private_room_ids(
+            request.user,
+            FeedViewerExclusion.create(request.user, exclude_talking_members=False),
+            self.paginate_by,
+            offset=self.paginate_by * (page - 1),
         )
-        private_rooms = [private_rooms.get(id=pk) for pk in id_list]
+        private_rooms_data = get_room_feed_payloads(id_list)  # TODO: context指定
 
-        serializer = RoomSerializer(private_rooms, many=True)  # TODO: context指定
         return Response(
             {
-                "private_rooms": serializer.data,
-                "has_more": not (len(private_rooms) < self.paginate_by),
+                "private_rooms": private_rooms_data,
+                "has_more": has_more,
             },
             status.HTTP_200_OK,
+            headers={"ETag": etag},
         )
 
 
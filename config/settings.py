@@ -159,13 +159,13 @@ MEDIA_URL = "/media/"
 MEDIA_ROOT = "/var/www/{}/media".format(PROJECT_NAME)
 
 # rest_framework
-DEFAULT_RENDERER_CLASSES_val = ["rest_framework.renderers.JSONRenderer"]
+DEFAULT_RENDERER_CLASSES_val = ["fullfii.lib.json_codec.JSONRenderer"]
 if DEBUG:
     DEFAULT_RENDERER_CLASSES_val.append("rest_framework.renderers.BrowsableAPIRenderer")
 REST_FRAMEWORK = {
     "DEFAULT_RENDERER_CLASSES": DEFAULT_RENDERER_CLASSES_val,
     "DEFAULT_PARSER_CLASSES": [
-        "rest_framework.parsers.JSONParser",
+        "fullfii.lib.json_codec.JSONParser",
     ],
     # JWT
     "DEFAULT_PERMISSION_CLASSES": ("rest_framework.permissions.IsAuthenticated",),
@@ -184,15 +184,32 @@ JWT_AUTH = {
 AUTH_USER_MODEL = "account.Account"
 
 
+REDIS_URL = env("REDIS_URL")
+
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
-            "hosts": [env("REDIS_URL")],
+            "hosts": [REDIS_URL],
         },
     }
 }
 
+# フィード等のキャッシュ ("redis": REDIS_URLを使用, "local": プロセス内. テスト用)
+CACHE_STORE_BACKEND = env("CACHE_STORE_BACKEND", default="redis")
+
+# チャットメッセージのwrite-behind (ワーカーごとにバッファし, 一定間隔 or 一定件数でbulk_create)
+MESSAGE_WRITE_BEHIND = env.bool("MESSAGE_WRITE_BEHIND", default=False)
+MESSAGE_WRITE_BEHIND_INTERVAL = env.float("MESSAGE_WRITE_BEHIND_INTERVAL", default=0.2)
+MESSAGE_WRITE_BEHIND_MAX_SIZE = env.int("MESSAGE_WRITE_BEHIND_MAX_SIZE", default=100)
+
+# FCMの送信キュー (ワーカースレッドでまとめてsend_all, 一時的なエラーは指数バックオフで再送)
+FCM_TRANSPORT = env("FCM_TRANSPORT", default="firebase")  # firebase or fake
+FCM_DISPATCH_WORKERS = env.int("FCM_DISPATCH_WORKERS", default=2)
+FCM_DISPATCH_INTERVAL = env.float("FCM_DISPATCH_INTERVAL", default=0.5)
+FCM_DISPATCH_MAX_RETRIES = env.int("FCM_DISPATCH_MAX_RETRIES", default=3)
+FCM_DISPATCH_BACKOFF = env.float("FCM_DISPATCH_BACKOFF", default=1.0)
+
 # Slack webhooks URL (git管理するとリジェクトされて使用禁止になるため.envで管理)
 SLACK_WEBHOOKS_FULLFII_BOT_URL = env("SLACK_WEBHOOKS_FULLFII_BOT_URL", default="")
 
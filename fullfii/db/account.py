@@ -1,13 +1,130 @@
-from fullfii.lib.utils import calc_file_num
-from config import settings
-import os
+import uuid
+from django.db import transaction
+from django.db.models import Q
+from account.models import Account
+from fullfii.lib.cache_store import get_cache_store
+from fullfii.lib.image_variants import get_saved_image_variants
 
 
-def exists_std_images(image_field):
-    try:
-        profile_image_num = calc_file_num(
-            os.path.dirname(settings.BASE_DIR + image_field.url)
+def exists_std_images(image_field, variation_name="medium"):
+    """
+    variationが描画済みか. モデルに保存済みのvariation名(未保存の場合manifest)を参照するため
+    ファイルシステムにはアクセスしない
+    """
+    if not image_field:
+        return False
+    return variation_name in get_saved_image_variants(image_field)
+
+
+def load_accounts(id_list):
+    """
+    id_listの順序でAccountを取得. プロフィール画像(UserSerializer.get_image)もまとめて取得する
+    """
+    accounts = Account.objects.select_related("image").in_bulk(id_list)
+    return [accounts[pk] for pk in id_list if pk in accounts]
+
+
+def get_favorite_user_ids(account):
+    """
+    accountのまた話したいユーザid(新しい順)
+    """
+    return list(
+        account.owner_favorite_user_relationship.order_by("-created_at").values_list(
+            "favorite_account", flat=True
         )
-        return profile_image_num > 1
-    except:
-        return
+    )
+
+
+### block graph ###
+# アカウントごとのブロックしている(outgoing)・ブロックされている(incoming)アカウントidをキャッシュする.
+# BlockedAccountsAPIView.patchでinvalidateする. 管理サイトでの変更はBLOCK_GRAPH_TIMEOUTで反映される.
+BLOCK_GRAPH_TIMEOUT = 60 * 10
+
+
+class BlockGraph:
+    def __init__(self, account_id, outgoing_ids, incoming_ids):
+        self.account_id = account_id
+        self.outgoing_ids = frozenset(outgoing_ids)
+        self.incoming_ids = frozenset(incoming_ids)
+        self.related_ids = self.outgoing_ids | self.incoming_ids
+
+    def is_blocked_between(self, other_id):
+        """ブロックしている or ブロックされている"""
+        return other_id in self.related_ids
+
+    def filter_unblocked(self, account_ids):
+        return [
+            account_id for account_id in account_ids if account_id not in self.related_ids
+        ]
+
+    @staticmethod
+    def get_cache_key(account_id):
+        return "block_graph:{}".format(str(account_id))
+
+    def to_data(self):
+        return [
+            [account_id.hex for account_id in self.outgoing_ids],
+            [account_id.hex for account_id in self.incoming_ids],
+        ]
+
+    @classmethod
+    def from_data(cls, account_id, data):
+        outgoing_hexes, incoming_hexes = data
+        return cls(
+            account_id,
+            [uuid.UUID(hex=account_id_hex) for account_id_hex in outgoing_hexes],
+            [uuid.UUID(hex=account_id_hex) for account_id_hex in incoming_hexes],
+        )
+
+    @classmethod
+    def get(cls, account_id):
+        return cls.get_many([account_id])[account_id]
+
+    @classmethod
+    def get_many(cls, account_ids):
+        """
+        return {account_id: BlockGraph}. キャッシュにないものはブロック中間テーブルへの1クエリでまとめて取得する.
+        """
+        store = get_cache_store()
+        keys = {account_id: cls.get_cache_key(account_id) for account_id in account_ids}
+        cached_data = store.get_many(keys.values())
+
+        block_graphs = {
+            account_id: cls.from_data(account_id, cached_data[key])
+            for account_id, key in keys.items()
+            if key in cached_data
+        }
+
+        missing_ids = [
+            account_id for account_id in account_ids if account_id not in block_graphs
+        ]
+        if missing_ids:
+            edges = {account_id: (set(), set()) for account_id in missing_ids}
+            blocks = Account.blocked_accounts.through.objects.filter(
+                Q(from_account_id__in=missing_ids) | Q(to_account_id__in=missing_ids)
+            ).values_list("from_account_id", "to_account_id")
+            for from_id, to_id in blocks:
+                if from_id in edges:
+                    edges[from_id][0].add(to_id)
+                if to_id in edges:
+                    edges[to_id][1].add(from_id)
+
+            missing_graphs = {
+                account_id: cls(account_id, outgoing_ids, incoming_ids)
+                for account_id, (outgoing_ids, incoming_ids) in edges.items()
+            }
+            store.set_many(
+                {
+                    keys[account_id]: block_graph.to_data()
+                    for account_id, block_graph in missing_graphs.items()
+                },
+                timeout=BLOCK_GRAPH_TIMEOUT,
+            )
+            block_graphs.update(missing_graphs)
+
+        return block_graphs
+
+    @classmethod
+    def invalidate(cls, *account_ids):
+        keys = [cls.get_cache_key(account_id) for account_id in account_ids]
+        transaction.on_commit(lambda: get_cache_store().delete(*keys))
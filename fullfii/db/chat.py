@@ -1,4 +1,23 @@
-from chat.models import RoomV4
+import heapq
+import threading
+import traceback
+import uuid
+from collections import namedtuple
+from datetime import datetime
+from itertools import dropwhile, islice
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import F, Prefetch, Q, Sum
+from django.utils import timezone
+from account.models import Account, Gender
+from chat.models import MessageV4, PrivateRoomInbox, RoomMemberWatermark, RoomV4
+from fullfii.db.account import BlockGraph
+from fullfii.lib.cache_store import get_cache_store
+from fullfii.lib.pagination import (
+    decode_cursor,
+    encode_cursor,
+    filter_after_cursor,
+    paginate_by_cursor,
+)
 
 
 def get_created_rooms(target_user):
@@ -13,3 +32,772 @@ def get_participating_rooms(target_user):
     return RoomV4.objects.filter(participants=target_user, is_active=True).exclude(
         closed_members=target_user
     )
+
+
+def get_talking_member_ids(target_user):
+    """
+    自分と話しているユーザ(作成ルームの参加者, 参加ルームのオーナー)のid集合.
+    ルーム数によらず参加者中間テーブルへの1クエリで取得する.
+    """
+    room_participants = RoomV4.participants.through.objects.filter(
+        Q(roomv4__owner=target_user) | Q(account=target_user), roomv4__is_active=True
+    ).exclude(roomv4__closed_members=target_user)
+    member_pairs = room_participants.values_list("roomv4__owner_id", "account_id")
+    return {member_id for pair in member_pairs for member_id in pair} - {
+        target_user.id
+    }
+
+
+def with_room_relations(rooms):
+    """
+    RoomSerializerで参照するowner, プロフィール画像, デフォルト画像をjoinし, メンバーをprefetchする
+    """
+    members = Account.objects.select_related("image")
+    return rooms.select_related("owner", "owner__image", "default_image").prefetch_related(
+        Prefetch("participants", queryset=members),
+        Prefetch("left_members", queryset=members),
+    )
+
+
+def load_rooms(id_list):
+    """
+    id_listのroomを1クエリ(+メンバーのprefetch)で取得し, id_listの順序で返す
+    """
+    if not id_list:
+        return []
+    rooms = with_room_relations(RoomV4.objects.filter(id__in=id_list))
+    room_dict = {room.id: room for room in rooms}
+    return [room_dict[pk] for pk in id_list if pk in room_dict]
+
+
+def get_open_rooms():
+    # 公開フィードの対象となるルーム (プライベートルームは含めない)
+    return RoomV4.objects.filter(
+        is_active=True, is_end=False, owner__is_active=True, is_private=False
+    )
+
+
+FeedEntry = namedtuple("FeedEntry", ["created_at", "id", "owner_id"])
+
+FeedSegmentKey = namedtuple(
+    "FeedSegmentKey",
+    [
+        "owner_gender",
+        "owner_is_secret_gender",
+        "owner_is_ban",
+        "is_exclude_different_gender",
+    ],
+)
+
+
+class FeedViewerExclusion:
+    """
+    閲覧者ごとに除外するルームid, オーナーidの集合. メモリ上で適用する.
+    """
+
+    def __init__(self, room_ids, owner_ids):
+        self.room_ids = room_ids
+        self.owner_ids = owner_ids
+
+    def excludes(self, entry):
+        return entry.id in self.room_ids or entry.owner_id in self.owner_ids
+
+    @classmethod
+    def create(cls, viewer, exclude_talking_members=True):
+        """
+        exclude_talking_members: 自分と話しているユーザのルームを除外するか (プライベートルームでは除外しない)
+        """
+        # 非表示ルーム, ブロックルーム, 参加中ルーム
+        room_ids = set(viewer.hidden_rooms.values_list("id", flat=True))
+        room_ids |= set(viewer.blocked_rooms.values_list("id", flat=True))
+        room_ids |= set(
+            RoomV4.objects.filter(
+                participants=viewer, is_active=True, is_end=False
+            ).values_list("id", flat=True)
+        )
+
+        # 自分, 自分と話しているユーザ
+        owner_ids = {viewer.id}
+        if exclude_talking_members:
+            owner_ids |= get_talking_member_ids(viewer)
+
+        # ブロックしているユーザ, ブロックされているユーザ
+        owner_ids |= BlockGraph.get(viewer.id).related_ids
+
+        return cls(room_ids, owner_ids)
+
+
+class RoomFeedVisibilityEngine:
+    """
+    公開中のルームをオーナー属性(性別, 性別内緒, 凍結, 異性非表示設定)でセグメント化し, セグメントごとに
+    (created_at, id)の降順の候補リストを保持する. 閲覧者に対しては表示可能なセグメントをmergeし,
+    FeedViewerExclusionをメモリ上で適用する.
+    """
+
+    def __init__(self, segments):
+        self.segments = segments  # {FeedSegmentKey: [FeedEntry, ...]}
+        self.token = None  # キャッシュされたsnapshotの識別子 (ETag用)
+
+    @classmethod
+    def build(cls):
+        rows = get_open_rooms().values_list(
+            "id",
+            "created_at",
+            "owner_id",
+            "owner__gender",
+            "owner__is_secret_gender",
+            "owner__is_ban",
+            "is_exclude_different_gender",
+        )
+        segments = {}
+        for pk, created_at, owner_id, *segment_key in rows:
+            segments.setdefault(FeedSegmentKey(*segment_key), []).append(
+                FeedEntry(created_at, pk, owner_id)
+            )
+        for entries in segments.values():
+            entries.sort(reverse=True)
+        return cls(segments)
+
+    def to_data(self):
+        return [
+            [
+                list(segment_key),
+                [
+                    [entry.created_at.isoformat(), str(entry.id), str(entry.owner_id)]
+                    for entry in entries
+                ],
+            ]
+            for segment_key, entries in self.segments.items()
+        ]
+
+    @classmethod
+    def from_data(cls, data):
+        return cls(
+            {
+                FeedSegmentKey(*segment_key): [
+                    FeedEntry(
+                        datetime.fromisoformat(created_at),
+                        uuid.UUID(pk),
+                        uuid.UUID(owner_id),
+                    )
+                    for created_at, pk, owner_id in entries
+                ]
+                for segment_key, entries in data
+            }
+        )
+
+    @staticmethod
+    def is_segment_visible(segment_key, viewer):
+        is_owner_gender_open = (
+            not segment_key.owner_is_secret_gender
+            and segment_key.owner_gender != Gender.NOTSET
+        )
+        is_viewer_gender_open = (
+            viewer.gender != Gender.NOTSET and not viewer.is_secret_gender
+        )
+
+        # 異性非表示設定 & オーナー性別設定済 : 自分の性別が設定済みかつオーナーと同性の場合のみ表示
+        if segment_key.is_exclude_different_gender and is_owner_gender_open:
+            if not is_viewer_gender_open or segment_key.owner_gender != viewer.gender:
+                return False
+
+        # 凍結されていたら, 女性は表示しない
+        if (
+            viewer.is_ban
+            and segment_key.owner_gender == Gender.FEMALE
+            and not segment_key.owner_is_secret_gender
+        ):
+            return False
+
+        # 女性の場合, 凍結ユーザは表示されない
+        if (
+            viewer.gender == Gender.FEMALE
+            and not viewer.is_secret_gender
+            and segment_key.owner_is_ban
+        ):
+            return False
+
+        return True
+
+    def iter_visible_entries(self, viewer, exclusion):
+        visible_segments = [
+            entries
+            for segment_key, entries in self.segments.items()
+            if self.is_segment_visible(segment_key, viewer)
+        ]
+        for entry in heapq.merge(*visible_segments, reverse=True):
+            if not exclusion.excludes(entry):
+                yield entry
+
+    def get_visible_room_ids(self, viewer, exclusion, limit, offset=0, cursor=None):
+        """
+        return (id_list, has_more, next_cursor)
+        """
+        entries = self.iter_visible_entries(viewer, exclusion)
+        if cursor:
+            cursor_key = decode_cursor(cursor)
+            entries = dropwhile(
+                lambda entry: (entry.created_at, entry.id) >= cursor_key, entries
+            )
+
+        page = list(islice(entries, offset, offset + limit + 1))
+        has_more = len(page) > limit
+        page = page[:limit]
+        next_cursor = (
+            encode_cursor(page[-1].created_at, page[-1].id) if has_more else None
+        )
+        return [entry.id for entry in page], has_more, next_cursor
+
+
+class RoomFeedQueryEngine:
+    """
+    snapshot未構築時に使用する. 表示可能なセグメントとFeedViewerExclusionをDBで適用し, 1ページ分のみ取得する.
+    (公開中のルーム数によらず, (created_at, id)の降順でlimit + 1件のみ読み込む)
+    """
+
+    token = None
+
+    @staticmethod
+    def get_hidden_q(viewer):
+        """
+        RoomFeedVisibilityEngine.is_segment_visibleで表示されないルームの条件
+        (セグメントのキーを列挙せず, 保存されている性別の値によらず同じ判定とする)
+        """
+        is_owner_gender_open = Q(owner__is_secret_gender=False) & ~Q(
+            owner__gender=Gender.NOTSET
+        )
+        is_viewer_gender_open = (
+            viewer.gender != Gender.NOTSET and not viewer.is_secret_gender
+        )
+
+        # 異性非表示設定 & オーナー性別設定済 : 自分の性別が設定済みかつオーナーと同性の場合のみ表示
+        hidden_q = Q(is_exclude_different_gender=True) & is_owner_gender_open
+        if is_viewer_gender_open:
+            hidden_q &= ~Q(owner__gender=viewer.gender)
+
+        # 凍結されていたら, 女性は表示しない
+        if viewer.is_ban:
+            hidden_q |= Q(owner__gender=Gender.FEMALE, owner__is_secret_gender=False)
+
+        # 女性の場合, 凍結ユーザは表示されない
+        if viewer.gender == Gender.FEMALE and not viewer.is_secret_gender:
+            hidden_q |= Q(owner__is_ban=True)
+
+        return hidden_q
+
+    def get_visible_room_ids(self, viewer, exclusion, limit, offset=0, cursor=None):
+        """
+        return (id_list, has_more, next_cursor)
+        """
+        rooms = (
+            get_open_rooms()
+            .exclude(self.get_hidden_q(viewer))
+            .exclude(id__in=exclusion.room_ids)
+            .exclude(owner_id__in=exclusion.owner_ids)
+        )
+        if cursor:
+            rooms = filter_after_cursor(rooms, cursor, "created_at")
+        rows = list(
+            rooms.order_by("-created_at", "-id").values_list("id", "created_at")[
+                offset : offset + limit + 1
+            ]
+        )
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][1], rows[-1][0]) if has_more else None
+        return [pk for pk, _ in rows], has_more, next_cursor
+
+
+### private room inbox ###
+def fan_out_private_room(room, recipient_ids=None):
+    """
+    プライベートルームを受信者(作成者がまた話したいユーザに登録した人)のinboxへ書き込む.
+    凍結ユーザのルーム, ブロックしている・されている受信者は書き込まない.
+    return 書き込んだ受信者のid list
+    """
+    if not room.is_private or room.is_end or not room.is_active or room.owner.is_ban:
+        return []
+
+    if recipient_ids is None:
+        recipient_ids = room.owner.owner_favorite_user_relationship.values_list(
+            "favorite_account", flat=True
+        )
+    recipient_ids = BlockGraph.get(room.owner_id).filter_unblocked(recipient_ids)
+
+    PrivateRoomInbox.objects.bulk_create(
+        [
+            PrivateRoomInbox(
+                recipient_id=recipient_id, room=room, created_at=room.created_at
+            )
+            for recipient_id in recipient_ids
+        ],
+        ignore_conflicts=True,
+    )
+    bump_user_versions(*recipient_ids)
+    return recipient_ids
+
+
+def fan_out_private_rooms_of_owner(owner, recipient_id=None):
+    """
+    また話したいユーザ登録時, 作成済みのプライベートルームを受信者のinboxへ書き込む.
+    recipient_idを指定しない場合, 全ての受信者のinboxへ書き込み直す (凍結解除・ブロック解除時)
+    """
+    for room in RoomV4.objects.filter(
+        owner=owner, is_private=True, is_active=True, is_end=False
+    ):
+        fan_out_private_room(
+            room, recipient_ids=[recipient_id] if recipient_id is not None else None
+        )
+
+
+def remove_private_room_inbox(room=None, owner=None, recipient=None):
+    """
+    指定したルーム, オーナー(のルーム), 受信者の組み合わせでinboxから削除する
+    """
+    entries = PrivateRoomInbox.objects.all()
+    if room is not None:
+        entries = entries.filter(room=room)
+    if owner is not None:
+        entries = entries.filter(room__owner=owner)
+    if recipient is not None:
+        entries = entries.filter(recipient=recipient)
+    entries.delete()
+
+
+def get_private_room_ids(viewer, exclusion, limit, offset=0):
+    """
+    inboxから閲覧可能なプライベートルームのidを取得する.
+    return (id_list, has_more)
+    """
+    entries = (
+        PrivateRoomInbox.objects.filter(
+            recipient=viewer,
+            room__is_active=True,
+            room__is_end=False,
+            room__owner__is_active=True,
+            room__owner__is_ban=False,
+        )
+        .order_by("-created_at", "-room_id")
+        .values_list("created_at", "room_id", "room__owner_id")
+    )
+    visible_entries = (
+        entry
+        for entry in map(FeedEntry._make, entries.iterator())
+        if not exclusion.excludes(entry)
+    )
+    page = list(islice(visible_entries, offset, offset + limit + 1))
+    return [entry.id for entry in page[:limit]], len(page) > limit
+
+
+### feed cache ###
+# 閲覧者に依存しない部分(セグメント化した公開中ルームと, contextなしのRoomSerializerのデータ)をキャッシュする.
+# ルームの作成・参加・終了・非活性, オーナーの凍結・退会・プロフィール変更時にinvalidate_room_feed()で世代を進めて無効化する.
+# 世代はランダムな値で, フィードのETagにも用いる (世代が変わらない限りETagは変わらない).
+FEED_CACHE_TIMEOUT = 60
+FEED_GENERATION_KEY = "feed:generation"
+
+_local_feed_engine = (None, None)  # (snapshot token, RoomFeedVisibilityEngine)
+
+
+def bump_feed_generation():
+    get_cache_store().set(FEED_GENERATION_KEY, uuid.uuid4().hex)
+
+
+def invalidate_room_feed():
+    # トランザクション内ではcommit後に無効化する (commit前のデータでキャッシュが再構築されないように)
+    transaction.on_commit(bump_feed_generation)
+
+
+def invalidate_room_feed_of_owner(owner):
+    """ownerのルームが公開中の場合のみ無効化する (フィードのデータにオーナーのプロフィールが含まれるため)"""
+    if RoomV4.objects.filter(owner=owner, is_active=True, is_end=False).exists():
+        invalidate_room_feed()
+
+
+def get_feed_generation():
+    return get_cache_token(FEED_GENERATION_KEY)
+
+
+def build_room_feed_snapshot(generation):
+    """generationのsnapshotを構築してキャッシュする"""
+    store = get_cache_store()
+    engine = RoomFeedVisibilityEngine.build()
+    engine.token = uuid.uuid4().hex
+    store.set(
+        "feed:{}:snapshot".format(generation),
+        engine.to_data(),
+        timeout=FEED_CACHE_TIMEOUT,
+    )
+    store.set(
+        "feed:{}:token".format(generation), engine.token, timeout=FEED_CACHE_TIMEOUT
+    )
+    return engine
+
+
+def _build_room_feed_snapshot_in_background(generation):
+    def run():
+        try:
+            close_old_connections()
+            build_room_feed_snapshot(generation)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            close_old_connections()
+
+    def start():
+        # 同一世代の構築は1ワーカーのみ
+        if get_cache_store().add(
+            "feed:{}:building".format(generation), True, timeout=FEED_CACHE_TIMEOUT
+        ):
+            threading.Thread(target=run, daemon=True).start()
+
+    # 別コネクションで構築するため, commit後に開始する (commit前のデータを含まないsnapshotをキャッシュしないように)
+    transaction.on_commit(start)
+
+
+def get_room_feed_engine():
+    """
+    キャッシュ済みのRoomFeedVisibilityEngineを返す. 同一世代のsnapshotはプロセス内でも再利用する.
+    snapshotが未構築の場合はバックグラウンドで構築し, 構築されるまではRoomFeedQueryEngineを返す
+    (リクエスト中に公開中の全ルームを読み込まないため).
+    """
+    global _local_feed_engine
+    store = get_cache_store()
+    generation = get_feed_generation()
+    token_key = "feed:{}:token".format(generation)
+    snapshot_key = "feed:{}:snapshot".format(generation)
+
+    token = store.get(token_key)
+    if token is not None:
+        local_token, local_engine = _local_feed_engine
+        if local_token == token:
+            return local_engine
+        snapshot_data = store.get(snapshot_key)
+        if snapshot_data is not None:
+            engine = RoomFeedVisibilityEngine.from_data(snapshot_data)
+            engine.token = token
+            _local_feed_engine = (token, engine)
+            return engine
+
+    _build_room_feed_snapshot_in_background(generation)
+    return RoomFeedQueryEngine()
+
+
+def get_room_feed_payloads(id_list):
+    """
+    id_listのroomのcontextなしRoomSerializerデータを, キャッシュ済みのものは再利用して返す
+    """
+    # chat.v4.fast_serializers -> fullfii -> fullfii.db.chat の循環importを避けるため
+    from chat.v4.fast_serializers import serialize_room
+
+    store = get_cache_store()
+    generation = get_feed_generation()
+    keys = {pk: "feed:{}:room:{}".format(generation, pk) for pk in id_list}
+    cached_payloads = store.get_many(keys.values())
+
+    missing_ids = [pk for pk in id_list if keys[pk] not in cached_payloads]
+    if missing_ids:
+        rooms = load_rooms(missing_ids)
+        missing_payloads = {
+            keys[room.id]: serialize_room(room) for room in rooms
+        }
+        store.set_many(missing_payloads, timeout=FEED_CACHE_TIMEOUT)
+        cached_payloads.update(missing_payloads)
+
+    return [cached_payloads[keys[pk]] for pk in id_list if keys[pk] in cached_payloads]
+
+
+### version tokens ###
+# ユーザごとの変更トークン. ルーム・メンバー・非表示・ブロック・また話したいユーザ等, そのユーザから見たフィードや
+# トーク情報が変わる変更時にbump(ランダムな値に更新)し, フィード(世代)と組み合わせてETagに用いる.
+# カウンタだとredisの再起動・evictionで以前の値に戻り, 古いETagと一致してしまうためランダムな値とする.
+def get_cache_token(key):
+    """keyのトークン. 未登録(evict含む)の場合は新しいトークンを登録する"""
+    store = get_cache_store()
+    token = store.get(key)
+    if token is None:
+        store.add(key, uuid.uuid4().hex)
+        token = store.get(key)
+    return token
+
+
+def get_user_version_key(account_id):
+    return "user:{}:version".format(str(account_id))
+
+
+def get_user_version(account_id):
+    return get_cache_token(get_user_version_key(account_id))
+
+
+def bump_user_versions(*account_ids):
+    keys = [get_user_version_key(account_id) for account_id in account_ids]
+
+    def bump():
+        get_cache_store().set_many({key: uuid.uuid4().hex for key in keys})
+
+    if keys:
+        transaction.on_commit(bump)
+
+
+def bump_room_member_versions(room):
+    """ルームのメンバー(作成者含む)のバージョンをbump"""
+    bump_user_versions(
+        room.owner_id, *room.participants.values_list("id", flat=True)
+    )
+
+
+### message sequence ###
+def create_messages_with_seq(messages):
+    """
+    messagesにルームごとの連番(seq)を時刻順に採番し, まとめて保存する.
+    ルームの行ロック(select_for_update)で採番を直列化する. message_idが保存済みのメッセージは無視される(保存済みのseqを設定する).
+    message_idが他のルームで保存済みのメッセージは保存しない.
+    あわせてメンバーの未読数(RoomMemberWatermark.unread_count)を加算する
+    return 保存した(保存済みを含む)メッセージ
+    """
+    with transaction.atomic():
+        room_ids = sorted({message.room_id for message in messages}, key=str)
+        locked_rooms = {
+            room.id: room
+            for room in RoomV4.objects.select_for_update()
+            .only("id", "owner_id", "last_message_seq")
+            .filter(id__in=room_ids)
+            .order_by("id")  # ロック順を固定
+        }
+
+        # 再送・再flushされたメッセージ (ルームのロック後に確認するため, 同一ルームでは競合しない)
+        saved_messages = {
+            str(pk): (str(room_id), seq)
+            for pk, room_id, seq in MessageV4.objects.filter(
+                id__in=[message.id for message in messages]
+            ).values_list("id", "room_id", "seq")
+        }
+        accepted_messages = []
+        new_messages_by_room = {}
+        for message in sorted(messages, key=lambda message: message.time):
+            if str(message.id) not in saved_messages:
+                new_messages_by_room.setdefault(message.room_id, []).append(message)
+            else:
+                saved_room_id, saved_seq = saved_messages[str(message.id)]
+                if saved_room_id != str(message.room_id):
+                    # 他のルームのメッセージと衝突 (再送として扱わない)
+                    print("message_idが他のルームで使用されています: {}".format(message.id))
+                    continue
+                message.seq = saved_seq
+            accepted_messages.append(message)
+
+        for room_id, new_messages in new_messages_by_room.items():
+            room = locked_rooms[room_id]
+            num_saved_messages = room.last_message_seq
+            for message in new_messages:
+                room.last_message_seq += 1
+                message.seq = room.last_message_seq
+            RoomV4.objects.filter(id=room_id).update(
+                last_message_seq=room.last_message_seq
+            )
+            _increment_unread_counts(room, new_messages, num_saved_messages)
+        MessageV4.objects.bulk_create(
+            [
+                message
+                for new_messages in new_messages_by_room.values()
+                for message in new_messages
+            ],
+            ignore_conflicts=True,
+        )
+    return accepted_messages
+
+
+def get_messages_since_seq(room, since_seq):
+    """seqがsince_seqより後のメッセージ. (room, seq)のuniqueインデックスの範囲スキャン"""
+    return MessageV4.objects.filter(room=room, seq__gt=since_seq).order_by("seq")
+
+
+def get_room_message_history(room, cursor, limit):
+    """
+    roomのメッセージを(time, id)のkeyset paginationで新しい順にlimit件取得する.
+    cursorが空の場合は最新から. 不正なcursorの場合InvalidCursorError
+    return (messages(時系列順), has_more, next_cursor)
+    """
+    id_list, has_more, next_cursor = paginate_by_cursor(
+        MessageV4.objects.filter(room=room), cursor, limit, "time"
+    )
+    message_dict = MessageV4.objects.in_bulk(id_list)
+    messages = [message_dict[pk] for pk in reversed(id_list) if pk in message_dict]
+    return messages, has_more, next_cursor
+
+
+### read / stored watermarks ###
+# 既読・保存済みはRoomMemberWatermark(ルーム・メンバーごとの位置)で管理し, 範囲比較で判定する.
+def _advance_watermark(field_name, account_id, room_id, time):
+    """
+    field_name(last_read_at or last_stored_at)をtimeまで進める. 後退はさせない.
+    位置が未作成の場合, 未読数は既読位置より後のメッセージ数から始める
+    """
+    watermarks = RoomMemberWatermark.objects.filter(
+        room_id=room_id, member_id=account_id
+    )
+    behind_watermarks = watermarks.filter(
+        Q(**{"{}__isnull".format(field_name): True})
+        | Q(**{"{}__lt".format(field_name): time})
+    )
+    if behind_watermarks.update(**{field_name: time}) or watermarks.exists():
+        return
+    try:
+        with transaction.atomic():
+            # メッセージ作成時の加算(create_messages_with_seq)とルームの行ロックで直列化する
+            RoomV4.objects.select_for_update().only("id").filter(id=room_id).first()
+            unread_messages = MessageV4.objects.filter(room_id=room_id)
+            if field_name == "last_read_at":
+                unread_messages = unread_messages.filter(time__gt=time)
+            is_closed = RoomV4.closed_members.through.objects.filter(
+                roomv4_id=room_id, account_id=account_id
+            ).exists()
+            RoomMemberWatermark.objects.create(
+                room_id=room_id,
+                member_id=account_id,
+                unread_count=0 if is_closed else unread_messages.count(),
+                **{field_name: time},
+            )
+    except IntegrityError:
+        # 同時に作成された場合 (unique_together)
+        behind_watermarks.update(**{field_name: time})
+
+
+def mark_room_messages_read(account_id, room_id, time=None):
+    """roomのtime(デフォルトは現在時刻)までのメッセージを既読にし, 未読数を再計算する"""
+    _advance_watermark("last_read_at", account_id, room_id, time or timezone.now())
+    with transaction.atomic():
+        # メッセージ作成時の加算と直列化する
+        watermark = RoomMemberWatermark.objects.select_for_update().get(
+            room_id=room_id, member_id=account_id
+        )
+        unread_count = MessageV4.objects.filter(
+            room_id=room_id, time__gt=watermark.last_read_at
+        ).count()
+        RoomMemberWatermark.objects.filter(id=watermark.id).update(
+            unread_count=unread_count
+        )
+
+
+def mark_room_messages_stored(account_id, room_id, time=None):
+    """roomのtime(デフォルトは現在時刻)までのメッセージを保存済みにする"""
+    _advance_watermark("last_stored_at", account_id, room_id, time or timezone.now())
+
+
+def mark_message_stored(account_id, message_id):
+    """
+    メッセージを保存済みにする. 位置をメッセージの時刻まで進める
+    (メッセージは時刻順に届くため, それ以前のメッセージは保存済みとみなす)
+    """
+    message = MessageV4.objects.only("room_id", "time").get(id=message_id)
+    mark_room_messages_stored(account_id, message.room_id, message.time)
+
+
+def get_not_stored_messages(account, room):
+    watermark = RoomMemberWatermark.objects.filter(room=room, member=account).first()
+    messages = MessageV4.objects.filter(room=room)
+    if watermark is not None and watermark.last_stored_at is not None:
+        messages = messages.filter(time__gt=watermark.last_stored_at)
+    return messages.order_by("time")
+
+
+### unread counts ###
+# プッシュ通知のバッジ用. RoomMemberWatermark.unread_countをメッセージ作成時に加算し, 既読時に再計算, クローズ時に0にする.
+# get_unread_message_countと異なる場合はreconcile_unread_countsコマンドで修復する.
+def _increment_unread_counts(room, new_messages, num_saved_messages):
+    """
+    roomのメンバー(クローズ済みを除く)の未読数に, 既読位置より後のnew_messagesの数を加算する.
+    (write-behind時は既読位置より前のメッセージが後から保存されるため)
+    位置が未作成のメンバーは全メッセージが未読のため, num_saved_messages(既存のメッセージ数)から始める
+    """
+    closed_member_ids = set(
+        RoomV4.closed_members.through.objects.filter(roomv4_id=room.id).values_list(
+            "account_id", flat=True
+        )
+    )
+    participant_ids = RoomV4.participants.through.objects.filter(
+        roomv4_id=room.id
+    ).values_list("account_id", flat=True)
+    member_ids = {room.owner_id, *participant_ids} - closed_member_ids
+
+    # 既読時の再計算(mark_room_messages_read)と直列化する
+    last_read_ats = dict(
+        RoomMemberWatermark.objects.select_for_update()
+        .filter(room_id=room.id, member_id__in=member_ids)
+        .values_list("member_id", "last_read_at")
+    )
+    RoomMemberWatermark.objects.bulk_create(
+        [
+            RoomMemberWatermark(
+                room_id=room.id,
+                member_id=member_id,
+                unread_count=num_saved_messages + len(new_messages),
+            )
+            for member_id in member_ids - set(last_read_ats)
+        ],
+        ignore_conflicts=True,
+    )
+
+    member_ids_by_count = {}
+    for member_id, last_read_at in last_read_ats.items():
+        num_unread_messages = len(
+            [
+                message
+                for message in new_messages
+                if last_read_at is None or message.time > last_read_at
+            ]
+        )
+        if num_unread_messages > 0:
+            member_ids_by_count.setdefault(num_unread_messages, []).append(member_id)
+    for num_unread_messages, _member_ids in member_ids_by_count.items():
+        RoomMemberWatermark.objects.filter(
+            room_id=room.id, member_id__in=_member_ids
+        ).update(unread_count=F("unread_count") + num_unread_messages)
+
+
+def clear_room_unread_count(account_id, room_id):
+    """クローズしたroomの未読数を0にする"""
+    RoomMemberWatermark.objects.filter(room_id=room_id, member_id=account_id).update(
+        unread_count=0
+    )
+
+
+def close_room_for_member(room, account_id):
+    """
+    roomをクローズし, 未読数を0にする. メッセージ作成時の加算(create_messages_with_seq)と
+    ルームの行ロックで直列化する (クローズ前のメンバーとして加算されないように)
+    """
+    with transaction.atomic():
+        RoomV4.objects.select_for_update().only("id").get(id=room.id)
+        room.closed_members.add(account_id)
+        clear_room_unread_count(account_id, room.id)
+
+
+def get_total_unread_count(account):
+    """バッジ用の未読数の合計. 1回のSUM"""
+    total = RoomMemberWatermark.objects.filter(member=account).aggregate(
+        total=Sum("unread_count")
+    )["total"]
+    return total or 0
+
+
+def get_unread_message_count(account, rooms):
+    """
+    rooms全体の未読メッセージ数. 既読位置の取得 + 1回のCOUNT (unread_countの修復時の正とする)
+    """
+    room_ids = [room.id for room in rooms]
+    if not room_ids:
+        return 0
+    last_read_ats = dict(
+        RoomMemberWatermark.objects.filter(
+            room_id__in=room_ids, member=account, last_read_at__isnull=False
+        ).values_list("room_id", "last_read_at")
+    )
+
+    unread_q = Q()
+    for room_id in room_ids:
+        if room_id in last_read_ats:
+            unread_q |= Q(room_id=room_id, time__gt=last_read_ats[room_id])
+        else:
+            unread_q |= Q(room_id=room_id)
+    return MessageV4.objects.filter(unread_q).count()
@@ -0,0 +1,195 @@
+import atexit
+import os
+import socket
+import threading
+import time
+import traceback
+from collections import deque
+from django.db import close_old_connections
+from fullfii.db.chat import create_messages_with_seq
+from fullfii.lib.cache_store import get_cache_store
+from config import settings
+
+
+### message write-behind ###
+# settings.MESSAGE_WRITE_BEHINDが有効な場合, ChatConsumerのメッセージはワーカー(プロセス)ごとにバッファし,
+# MESSAGE_WRITE_BEHIND_INTERVAL秒ごと, またはMESSAGE_WRITE_BEHIND_MAX_SIZE件に達した時点でbulk_createする.
+# message_id(クライアント指定)が主キーのため, 同一メッセージの再送・再flushは無視される.
+# seqはflush時に採番するため, バッファ中のメッセージのchat_messageフレームのseqはNoneとなる.
+# 切断時(ChatConsumer._disconnect)とプロセス終了時(atexit)にflushする.
+# flushに失敗した場合は1件ずつ保存し直し, max_retries回失敗したメッセージはdead_lettersへ移して破棄する.
+MESSAGE_BUFFER_METRICS_KEY_FORMAT = "metrics:message_buffer:{}"
+MESSAGE_BUFFER_WORKERS_KEY = "metrics:message_buffer:workers"
+MESSAGE_BUFFER_METRICS_TIMEOUT = 60 * 5
+
+
+class MessageWriteBuffer:
+    def __init__(self, flush_interval, max_size, max_retries=3):
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.max_retries = max_retries
+        self.worker_name = "{}-{}".format(socket.gethostname(), os.getpid())
+        self._messages = {}  # {message_id: MessageV4}
+        self._num_failures = {}  # {message_id: 保存に失敗した回数}
+        self.dead_letters = deque(maxlen=100)  # 破棄したメッセージ
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # flushの直列化
+        self._wake = threading.Event()
+        self._thread = None
+        self.metrics = {
+            "depth": 0,
+            "max_depth": 0,
+            "flushed_messages": 0,
+            "flush_count": 0,
+            "last_flush_ms": 0,
+            "max_flush_ms": 0,
+            "failed_flush_count": 0,
+            "dropped_messages": 0,
+        }
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def add(self, message):
+        with self._lock:
+            self._messages[str(message.id)] = message
+            depth = len(self._messages)
+            self.metrics["depth"] = depth
+            self.metrics["max_depth"] = max(self.metrics["max_depth"], depth)
+        if depth >= self.max_size:
+            self._wake.set()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                messages = list(self._messages.values())
+                self._messages = {}
+                self.metrics["depth"] = 0
+            if not messages:
+                return
+
+            start = time.perf_counter()
+            try:
+                accepted_messages = create_messages_with_seq(messages)
+                messages = self._drop_rejected(messages, accepted_messages)
+            except Exception:
+                self.metrics["failed_flush_count"] += 1
+                traceback.print_exc()
+                # 1件ずつ保存し, 失敗したメッセージのみ次回のflushで再試行する
+                messages = self._save_one_by_one(messages)
+            flush_ms = (time.perf_counter() - start) * 1000
+
+            self.metrics["flushed_messages"] += len(messages)
+            self.metrics["flush_count"] += 1
+            self.metrics["last_flush_ms"] = round(flush_ms, 3)
+            self.metrics["max_flush_ms"] = max(
+                self.metrics["max_flush_ms"], self.metrics["last_flush_ms"]
+            )
+
+    def _save_one_by_one(self, messages):
+        """
+        return 保存できたメッセージ
+        """
+        saved_messages = []
+        for message in messages:
+            message_id = str(message.id)
+            try:
+                accepted_messages = create_messages_with_seq([message])
+                if not self._drop_rejected([message], accepted_messages):
+                    continue
+            except Exception:
+                num_failures = self._num_failures.get(message_id, 0) + 1
+                if num_failures >= self.max_retries:
+                    self._num_failures.pop(message_id, None)
+                    self.dead_letters.append(message)
+                    self.metrics["dropped_messages"] += 1
+                    print("メッセージの保存に失敗したため破棄しました: {}".format(message_id))
+                    continue
+                self._num_failures[message_id] = num_failures
+                # 後から追加された同一idのメッセージを優先
+                with self._lock:
+                    self._messages.setdefault(message_id, message)
+                    self.metrics["depth"] = len(self._messages)
+            else:
+                self._num_failures.pop(message_id, None)
+                saved_messages.append(message)
+        return saved_messages
+
+    def _drop_rejected(self, messages, accepted_messages):
+        """
+        保存されなかった(message_idが他のルームで使用されている)メッセージはdead_lettersへ移す.
+        return accepted_messages
+        """
+        accepted_ids = {str(message.id) for message in accepted_messages}
+        for message in messages:
+            if str(message.id) not in accepted_ids:
+                self.dead_letters.append(message)
+                self.metrics["dropped_messages"] += 1
+        return accepted_messages
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                close_old_connections()
+                self.flush()
+            except Exception:
+                print("メッセージのflushに失敗しました")
+            try:
+                self.record_metrics()
+            except Exception:
+                pass
+
+    def record_metrics(self):
+        store = get_cache_store()
+        store.set(
+            MESSAGE_BUFFER_METRICS_KEY_FORMAT.format(self.worker_name),
+            self.metrics,
+            timeout=MESSAGE_BUFFER_METRICS_TIMEOUT,
+        )
+        worker_names = store.get(MESSAGE_BUFFER_WORKERS_KEY) or []
+        if self.worker_name not in worker_names:
+            store.set(
+                MESSAGE_BUFFER_WORKERS_KEY,
+                [*worker_names, self.worker_name],
+                timeout=MESSAGE_BUFFER_METRICS_TIMEOUT,
+            )
+
+
+def get_message_buffer_metrics():
+    """
+    ワーカーごとのバッファのメトリクス {worker_name: metrics}
+    """
+    store = get_cache_store()
+    worker_names = store.get(MESSAGE_BUFFER_WORKERS_KEY) or []
+    metrics = store.get_many(
+        [MESSAGE_BUFFER_METRICS_KEY_FORMAT.format(name) for name in worker_names]
+    )
+    return {
+        name: metrics[MESSAGE_BUFFER_METRICS_KEY_FORMAT.format(name)]
+        for name in worker_names
+        if MESSAGE_BUFFER_METRICS_KEY_FORMAT.format(name) in metrics
+    }
+
+
+_message_buffer = None
+
+
+def get_message_buffer():
+    """
+    write-behindが無効な場合None
+    """
+    global _message_buffer
+    if not getattr(settings, "MESSAGE_WRITE_BEHIND", False):
+        return
+    if _message_buffer is None:
+        _message_buffer = MessageWriteBuffer(
+            flush_interval=settings.MESSAGE_WRITE_BEHIND_INTERVAL,
+            max_size=settings.MESSAGE_WRITE_BEHIND_MAX_SIZE,
+        )
+        _message_buffer.start()
+    return _message_buffer
@@ -13,7 +13,7 @@ def authenticate_jwt(jwt_token, is_async=False):
 
     @sync_to_async
     def get_user(_user_id):
-        users = Account.objects.filter(id=_user_id)
+        users = Account.objects.select_related("image").filter(id=_user_id)
         if users.exists():
             return users.first()
         return
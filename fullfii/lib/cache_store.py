@@ -0,0 +1,169 @@
+import threading
+import time
+from contextlib import contextmanager
+from config import settings
+from fullfii.lib import json_codec
+
+
+class LocalCacheStore:
+    """
+    プロセス内キャッシュ. テストやredisが利用できない環境で使用する.
+    """
+
+    def __init__(self):
+        self._data = {}  # {key: (value, expires_at)}
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        if key not in self._data:
+            return
+        value, expires_at = self._data[key]
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return
+        return value
+
+    def _set(self, key, value, timeout):
+        expires_at = time.monotonic() + timeout if timeout is not None else None
+        # redisと同様にJSONで保持し, 呼び出し側での破壊的変更の影響を受けないようにする
+        self._data[key] = (json_codec.dumps(value), expires_at)
+
+    def get(self, key):
+        with self._lock:
+            value = self._get(key)
+        return json_codec.loads(value) if value is not None else None
+
+    def get_many(self, keys):
+        with self._lock:
+            values = {key: self._get(key) for key in keys}
+        return {
+            key: json_codec.loads(value)
+            for key, value in values.items()
+            if value is not None
+        }
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._set(key, value, timeout)
+
+    def set_many(self, mapping, timeout=None):
+        with self._lock:
+            for key, value in mapping.items():
+                self._set(key, value, timeout)
+
+    def add(self, key, value, timeout=None):
+        """未登録の場合のみ登録する. return 登録したか"""
+        with self._lock:
+            if self._get(key) is not None:
+                return False
+            self._set(key, value, timeout)
+            return True
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            value = self._get(key)
+            value = json_codec.loads(value) + 1 if value is not None else 1
+            self._data[key] = (json_codec.dumps(value), None)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data = {}
+
+
+class RedisCacheStore:
+    """
+    REDIS_URL(channel layerと同一インスタンス)を使用するキャッシュ. 値はJSONで保持する.
+    """
+
+    key_prefix = "fullfii:"
+
+    def __init__(self, url):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+
+    def _key(self, key):
+        return self.key_prefix + key
+
+    def get(self, key):
+        value = self.client.get(self._key(key))
+        return json_codec.loads(value) if value is not None else None
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.client.mget([self._key(key) for key in keys])
+        return {
+            key: json_codec.loads(value)
+            for key, value in zip(keys, values)
+            if value is not None
+        }
+
+    def set(self, key, value, timeout=None):
+        self.client.set(self._key(key), json_codec.dumps(value), ex=timeout)
+
+    def set_many(self, mapping, timeout=None):
+        if not mapping:
+            return
+        pipeline = self.client.pipeline()
+        for key, value in mapping.items():
+            pipeline.set(self._key(key), json_codec.dumps(value), ex=timeout)
+        pipeline.execute()
+
+    def add(self, key, value, timeout=None):
+        """未登録の場合のみ登録する. return 登録したか"""
+        return bool(
+            self.client.set(self._key(key), json_codec.dumps(value), ex=timeout, nx=True)
+        )
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self._key(key) for key in keys])
+
+    def incr(self, key):
+        return self.client.incr(self._key(key))
+
+    def clear(self):
+        keys = list(self.client.scan_iter(self._key("*")))
+        if keys:
+            self.client.delete(*keys)
+
+
+_cache_store = None
+
+
+def get_cache_store():
+    """
+    settings.CACHE_STORE_BACKEND("redis" or "local")に応じたキャッシュを返す
+    """
+    global _cache_store
+    if _cache_store is None:
+        backend = getattr(settings, "CACHE_STORE_BACKEND", "redis")
+        if backend == "redis":
+            try:
+                _cache_store = RedisCacheStore(settings.REDIS_URL)
+            except ImportError:
+                print("redisがインストールされていないため, LocalCacheStoreを使用します")
+                _cache_store = LocalCacheStore()
+        else:
+            _cache_store = LocalCacheStore()
+    return _cache_store
+
+
+@contextmanager
+def override_cache_store(store):
+    """ベンチマーク等で一時的にキャッシュを差し替える (共有のredisへ書き込まないため)"""
+    global _cache_store
+    original_cache_store = _cache_store
+    _cache_store = store
+    try:
+        yield store
+    finally:
+        _cache_store = original_cache_store
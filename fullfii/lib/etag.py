@@ -0,0 +1,22 @@
+import hashlib
+from rest_framework import status
+from rest_framework.response import Response
+
+
+def build_etag(*parts):
+    """バージョン等のpartsからETagを生成"""
+    digest = hashlib.md5("|".join(str(part) for part in parts).encode("utf-8"))
+    return '"{}"'.format(digest.hexdigest())
+
+
+def is_not_modified(request, etag):
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH", "")
+    client_etags = [
+        client_etag.strip()[2:] if client_etag.strip().startswith("W/") else client_etag.strip()
+        for client_etag in if_none_match.split(",")
+    ]
+    return etag in client_etags or "*" in client_etags
+
+
+def not_modified_response(etag):
+    return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
@@ -0,0 +1,204 @@
+import atexit
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+from django.db import close_old_connections
+import firebase_admin
+from firebase_admin import credentials, exceptions, messaging
+
+
+### fcm dispatcher ###
+# FCMの送信はリクエスト・WebSocketの処理中に行わず, キュー(ワーカー(プロセス)ごと)に積んで即座に返す.
+# ワーカースレッドがbatch_interval秒 or batch_size件ごとにまとめ, send_allで一括送信する.
+# 一時的なエラー(retryable)はbackoff * 2 ** attempt秒待って再送し, それ以外はトークンごとに失敗を記録する.
+FCM_SEND_ALL_MAX_SIZE = 500  # send_allの上限
+
+
+class FCMSendError(Exception):
+    def __init__(self, message, retryable=False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class FirebaseTransport:
+    retryable_errors = (
+        exceptions.UnavailableError,
+        exceptions.InternalError,
+        exceptions.DeadlineExceededError,
+        messaging.QuotaExceededError,
+    )
+
+    def __init__(self, credentials_path):
+        self.credentials_path = credentials_path
+
+    def send_all(self, messages):
+        """
+        return messagesと同順のエラーのリスト (成功時None)
+        """
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app(
+                credentials.Certificate(self.credentials_path)
+            )
+        try:
+            batch_response = messaging.send_all(messages)
+        except exceptions.FirebaseError as e:
+            raise self.to_send_error(e)
+        return [
+            None if response.success else self.to_send_error(response.exception)
+            for response in batch_response.responses
+        ]
+
+    def to_send_error(self, e):
+        return FCMSendError(str(e), retryable=isinstance(e, self.retryable_errors))
+
+
+class FakeFCMTransport:
+    """
+    テスト・ローカル用. 送信せずにsent_batchesへ記録する.
+    failures: {token: [FCMSendError, ...]} 送信のたびに先頭から1つずつ失敗させる
+    """
+
+    def __init__(self, failures=None):
+        self.failures = {token: list(errors) for token, errors in (failures or {}).items()}
+        self.sent_batches = []
+
+    def send_all(self, messages):
+        self.sent_batches.append([message.token for message in messages])
+        return [
+            self.failures[message.token].pop(0)
+            if self.failures.get(message.token)
+            else None
+            for message in messages
+        ]
+
+
+class FCMDispatcher:
+    def __init__(
+        self,
+        transport,
+        build_message,
+        num_workers=1,
+        batch_size=FCM_SEND_ALL_MAX_SIZE,
+        batch_interval=0.5,
+        max_retries=3,
+        backoff=1.0,
+    ):
+        """
+        build_message: (to_user, action) => 送信するメッセージ(tokenを持つ). 送信しない場合None
+        """
+        self.transport = transport
+        self.build_message = build_message
+        self.num_workers = num_workers
+        self.batch_size = min(batch_size, FCM_SEND_ALL_MAX_SIZE)
+        self.batch_interval = batch_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._queue = queue.Queue()
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._metrics_lock = threading.Lock()  # 複数のワーカースレッドから更新するため
+        self.failures = deque(maxlen=100)  # [(token, error)] 直近の失敗
+        self.metrics = {
+            "sent": 0,
+            "failed": 0,
+            "retried": 0,
+            "batch_count": 0,
+        }
+
+    def start(self):
+        with self._start_lock:
+            if self._threads:
+                return
+            for _ in range(self.num_workers):
+                thread = threading.Thread(target=self._run, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            atexit.register(self.dispatch_pending)
+
+    def enqueue(self, to_user, action):
+        self._queue.put((to_user, action))
+
+    def dispatch_pending(self):
+        """キューに積まれている通知をこのスレッドで送信する"""
+        items = []
+        while True:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        self.dispatch(items)
+
+    def dispatch(self, items):
+        messages = []
+        for to_user, action in items:
+            try:
+                message = self.build_message(to_user, action)
+            except Exception:
+                traceback.print_exc()
+                continue
+            if message is not None:
+                messages.append(message)
+
+        for i in range(0, len(messages), self.batch_size):
+            self.send_with_retry(messages[i : i + self.batch_size])
+
+    def send_with_retry(self, messages):
+        pending_messages = messages
+        for attempt in range(self.max_retries + 1):
+            self.increment_metric("batch_count")
+            try:
+                errors = self.transport.send_all(pending_messages)
+            except FCMSendError as e:
+                errors = [e] * len(pending_messages)
+
+            retry_messages = []
+            num_sent = 0
+            for message, error in zip(pending_messages, errors):
+                if error is None:
+                    num_sent += 1
+                elif error.retryable and attempt < self.max_retries:
+                    retry_messages.append(message)
+                else:
+                    self.report_failure(message, error)
+            self.increment_metric("sent", num_sent)
+            if not retry_messages:
+                return
+
+            self.increment_metric("retried", len(retry_messages))
+            time.sleep(self.backoff * 2 ** attempt)
+            pending_messages = retry_messages
+
+    def increment_metric(self, name, value=1):
+        with self._metrics_lock:
+            self.metrics[name] += value
+
+    def report_failure(self, message, error):
+        with self._metrics_lock:
+            self.metrics["failed"] += 1
+            self.failures.append((message.token, str(error)))
+        print("FCMの送信に失敗しました: {} {}".format(message.token, error))
+
+    def _take_batch(self):
+        """1件目が積まれるまで待ち, batch_interval秒 or batch_size件までまとめる"""
+        items = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_interval
+        while len(items) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                items.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        while True:
+            items = self._take_batch()
+            try:
+                close_old_connections()
+                self.dispatch(items)
+            except Exception:
+                traceback.print_exc()
@@ -1,55 +1,78 @@
-from fullfii.db.chat import get_created_rooms, get_participating_rooms
+from fullfii.db.chat import get_total_unread_count
 from channels.db import DatabaseSyncToAsync
 from django.db.models.query_utils import Q
-from chat.models import MessageV2, MessageV4, TalkStatus, TalkTicket, TalkingRoom
-import firebase_admin
-from firebase_admin import credentials
+from chat.models import MessageV2, TalkStatus, TalkTicket, TalkingRoom
+from asgiref.sync import async_to_sync
 from firebase_admin import messaging
-import traceback
+from fullfii.lib.fcm_dispatcher import FakeFCMTransport, FCMDispatcher, FirebaseTransport
+from config import settings
 
 
-async def send_fcm(to_user, action):
-    if not firebase_admin._apps:
-        cred = credentials.Certificate(
-            "/var/www/static/fullfii-firebase-adminsdk-cn02h-2e2b2efd56.json"
+FIREBASE_CREDENTIALS_PATH = (
+    "/var/www/static/fullfii-firebase-adminsdk-cn02h-2e2b2efd56.json"
+)
+_fcm_dispatcher = None
+
+
+def get_fcm_dispatcher():
+    global _fcm_dispatcher
+    if _fcm_dispatcher is None:
+        transport = (
+            FakeFCMTransport()
+            if settings.FCM_TRANSPORT == "fake"
+            else FirebaseTransport(FIREBASE_CREDENTIALS_PATH)
         )
-        firebase_admin.initialize_app(cred)
+        _fcm_dispatcher = FCMDispatcher(
+            transport,
+            build_fcm_message,
+            num_workers=settings.FCM_DISPATCH_WORKERS,
+            batch_interval=settings.FCM_DISPATCH_INTERVAL,
+            max_retries=settings.FCM_DISPATCH_MAX_RETRIES,
+            backoff=settings.FCM_DISPATCH_BACKOFF,
+        )
+        _fcm_dispatcher.start()
+    return _fcm_dispatcher
+
+
+def enqueue_fcm(to_user, action):
+    """
+    FCMの送信をキューに積む. 送信はFCMDispatcherのワーカースレッドで行う
+    """
+    if not to_user.device_token:
+        return
+    get_fcm_dispatcher().enqueue(to_user, action)
+
 
+def build_fcm_message(to_user, action):
+    """
+    FCMDispatcherのワーカースレッドで呼ばれる. 送信しない場合None
+    """
     registration_token = to_user.device_token
     if not registration_token:
         return
 
-    fcm_reducer_result = await fcm_reducer(to_user, action)
+    fcm_reducer_result = async_to_sync(fcm_reducer)(to_user, action)
     if fcm_reducer_result is None:
         return
 
-    try:
-        badge_apns = (
-            messaging.APNSConfig(
-                payload=messaging.APNSPayload(
-                    aps=messaging.Aps(badge=fcm_reducer_result["badge"])
-                )
+    badge_apns = (
+        messaging.APNSConfig(
+            payload=messaging.APNSPayload(
+                aps=messaging.Aps(badge=fcm_reducer_result["badge"])
             )
-            if fcm_reducer_result["badge"] > 0
-            else None
         )
+        if fcm_reducer_result["badge"] > 0
+        else None
+    )
 
-        message = messaging.Message(
-            notification=messaging.Notification(
-                title=fcm_reducer_result["title"],
-                body=fcm_reducer_result["body"],
-            ),
-            apns=badge_apns,
-            token=registration_token,
-        )
-
-        try:
-            response = messaging.send(message)
-            print("Successfully sent message:", response)
-        except:
-            traceback.print_exc()
-    except:
-        traceback.print_exc()
+    return messaging.Message(
+        notification=messaging.Notification(
+            title=fcm_reducer_result["title"],
+            body=fcm_reducer_result["body"],
+        ),
+        apns=badge_apns,
+        token=registration_token,
+    )
 
 
 async def fcm_reducer(to_user, action):
@@ -146,20 +169,4 @@ def fetch_total_unread_count(to_user):
 
 @DatabaseSyncToAsync
 def fetch_total_unread_count_v4(receiver):
-    total_unread_count = 0
-    created_rooms = get_created_rooms(receiver)
-    participating_rooms = get_participating_rooms(receiver)
-
-    def getUnreadMessageCount(_talking_rooms):
-        cnt = 0
-        for talking_room in _talking_rooms:
-            messages = MessageV4.objects.filter(room=talking_room).exclude(
-                read_participants=receiver.id
-            )
-            cnt += messages.count()
-        return cnt
-
-    total_unread_count += getUnreadMessageCount(created_rooms)
-    total_unread_count += getUnreadMessageCount(participating_rooms)
-
-    return total_unread_count
+    return get_total_unread_count(receiver)
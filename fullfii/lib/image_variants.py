@@ -0,0 +1,102 @@
+import time
+from collections import OrderedDict
+from stdimage.models import StdImageFieldFile
+from fullfii.lib.cache_store import get_cache_store
+
+
+### image variant manifest ###
+# StdImageFieldのvariation(large, thumbnail, medium)の描画結果を記録する.
+# シリアライズ時にos.listdirでvariationの有無を確認しないため.
+# 描画済みのvariation名はモデルの{field_name}_variants(カンマ区切り)に保存し, 保存前(未backfill)の画像のみ
+# ファイル名ごとのキャッシュを参照する. 既存の画像はbackfill_image_variantsコマンドで記録する.
+LOCAL_IMAGE_VARIANTS_MAX_SIZE = 10000
+LOCAL_IMAGE_VARIANTS_MISS_TIMEOUT = 60  # 未記録の画像の再確認間隔
+
+# {file_name: (frozenset(variation_names), expires_at)} 記録済みのものはexpires_at=None
+_local_image_variants = OrderedDict()
+
+
+def get_image_variants_key(file_name):
+    return "image_variants:{}".format(file_name)
+
+
+def _set_local_image_variants(file_name, variation_names, expires_at=None):
+    _local_image_variants[file_name] = (frozenset(variation_names), expires_at)
+    _local_image_variants.move_to_end(file_name)
+    while len(_local_image_variants) > LOCAL_IMAGE_VARIANTS_MAX_SIZE:
+        _local_image_variants.popitem(last=False)
+
+
+def record_image_variants(file_name, variation_names):
+    variation_names = sorted(variation_names)
+    get_cache_store().set(get_image_variants_key(file_name), variation_names)
+    _set_local_image_variants(file_name, variation_names)
+
+
+def get_image_variants(file_name):
+    """
+    記録済みのvariation名. 未記録の場合空のfrozenset
+    """
+    local_image_variants = _local_image_variants.get(file_name)
+    if local_image_variants is not None:
+        variation_names, expires_at = local_image_variants
+        if expires_at is None or expires_at > time.monotonic():
+            return variation_names
+
+    variation_names = get_cache_store().get(get_image_variants_key(file_name))
+    if variation_names is None:
+        _set_local_image_variants(
+            file_name, [], time.monotonic() + LOCAL_IMAGE_VARIANTS_MISS_TIMEOUT
+        )
+        return frozenset()
+    _set_local_image_variants(file_name, variation_names)
+    return frozenset(variation_names)
+
+
+def get_variants_field_name(field_name):
+    return "{}_variants".format(field_name)
+
+
+def get_saved_image_variants(image_field):
+    """
+    image_field(StdImageFieldFile)の描画済みのvariation名. モデルに保存済みの値を優先する
+    """
+    variants = getattr(
+        image_field.instance, get_variants_field_name(image_field.field.name), None
+    )
+    if variants is not None:
+        return frozenset(variants.split(",")) if variants else frozenset()
+    return get_image_variants(image_field.name)
+
+
+def save_image_variants(instance, field_name):
+    """
+    モデルのsave後に呼び, 描画済みのvariation名を{field_name}_variantsへ保存する (変更がある場合のみ)
+    """
+    image_field = getattr(instance, field_name)
+    variants_field_name = get_variants_field_name(field_name)
+    saved_variants = getattr(instance, variants_field_name)
+    if not image_field:
+        variants = ""
+    elif image_field.name in _local_image_variants or saved_variants is None:
+        # このプロセスで描画した画像, または未保存の画像
+        variants = ",".join(sorted(get_image_variants(image_field.name)))
+    else:
+        return
+    if saved_variants == variants:
+        return
+    setattr(instance, variants_field_name, variants)
+    type(instance).objects.filter(pk=instance.pk).update(
+        **{variants_field_name: variants}
+    )
+
+
+def render_and_record_variations(file_name, variations, storage):
+    """
+    StdImageFieldのrender_variationsに指定する. variationを描画し, manifestに記録する.
+    描画済みのためFalseを返す(StdImageFieldFile側で再描画させない)
+    """
+    for variation in variations.values():
+        StdImageFieldFile.render_variation(file_name, variation, storage=storage)
+    record_image_variants(file_name, variations.keys())
+    return False
@@ -0,0 +1,85 @@
+import datetime
+import decimal
+import json
+import uuid
+from django.utils.encoding import force_str
+from django.utils.functional import Promise
+from rest_framework import parsers, renderers
+from rest_framework.exceptions import ParseError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+### json codec ###
+# REST APIのレンダラ・パーサ, WebSocketのフレーム, キャッシュストアで共通して使用する.
+# orjsonがインストールされていれば使用し, なければ標準のjsonにフォールバックする.
+# UUIDは文字列, datetimeはisoformatで出力する(両者で同一).
+def _default(obj):
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    if isinstance(obj, Promise):  # gettext_lazy等
+        return force_str(obj)
+    raise TypeError(
+        "Object of type {} is not JSON serializable".format(type(obj).__name__)
+    )
+
+
+class _StdlibJSONEncoder(json.JSONEncoder):
+    def default(self, obj):
+        return _default(obj)
+
+
+if orjson is not None:
+
+    def dumps_bytes(obj):
+        return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+    def dumps(obj):
+        return dumps_bytes(obj).decode("utf-8")
+
+    def loads(data):
+        return orjson.loads(data)
+
+
+else:
+
+    def dumps(obj):
+        return json.dumps(
+            obj, cls=_StdlibJSONEncoder, ensure_ascii=False, separators=(",", ":")
+        )
+
+    def dumps_bytes(obj):
+        return dumps(obj).encode("utf-8")
+
+    def loads(data):
+        return json.loads(data)
+
+
+class JSONRenderer(renderers.JSONRenderer):
+    """
+    DRFのJSONRendererの代替. BrowsableAPI等でindentが指定された場合は従来の処理を使用する
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        return dumps_bytes(data)
+
+
+class JSONParser(parsers.JSONParser):
+    """DRFのJSONParserの代替"""
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return loads(stream.read())
+        except ValueError as e:
+            raise ParseError("JSON parse error - %s" % str(e))
@@ -0,0 +1,58 @@
+import base64
+import binascii
+import uuid
+from datetime import datetime
+from django.db.models import Q
+
+
+class InvalidCursorError(ValueError):
+    pass
+
+
+def encode_cursor(time, pk):
+    """
+    (時刻, id) => 不透明なカーソル文字列
+    """
+    raw = "{}|{}".format(time.isoformat(), str(pk))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    カーソル文字列 => (時刻, id). 不正なカーソルの場合InvalidCursorError
+    """
+    try:
+        padded_cursor = cursor + "=" * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded_cursor.encode("ascii")).decode("utf-8")
+        _time, _pk = raw.split("|")
+        return datetime.fromisoformat(_time), uuid.UUID(_pk)
+    except (ValueError, UnicodeError, binascii.Error):
+        raise InvalidCursorError("不正なカーソルです")
+
+
+def filter_after_cursor(queryset, cursor, time_field):
+    """
+    (time_field, id)の降順で, cursorより後ろのレコードに絞り込む
+    """
+    time, pk = decode_cursor(cursor)
+    return queryset.filter(
+        Q(**{"{}__lt".format(time_field): time})
+        | Q(**{time_field: time, "id__lt": pk})
+    )
+
+
+def paginate_by_cursor(queryset, cursor, limit, time_field):
+    """
+    keyset pagination. limit + 1件取得することでhas_moreの判定に追加クエリを発行しない.
+    cursorが空の場合は先頭から取得する.
+    return (id_list, has_more, next_cursor)
+    """
+    queryset = queryset.order_by("-{}".format(time_field), "-id")
+    if cursor:
+        queryset = filter_after_cursor(queryset, cursor, time_field)
+
+    rows = list(queryset.values_list("id", time_field)[: limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    next_cursor = encode_cursor(rows[-1][1], rows[-1][0]) if has_more else None
+    return [pk for pk, _ in rows], has_more, next_cursor
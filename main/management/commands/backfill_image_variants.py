@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from account.models import ProfileImage
+from chat.models import DefaultRoomImage, RoomV4
+from fullfii.lib.image_variants import get_variants_field_name, record_image_variants
+
+
+class Command(BaseCommand):
+    help = "既存の画像について描画済みのvariationをモデルとmanifestへ記録する (manifest導入前にアップロードされた画像用)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--render", action="store_true", help="未描画のvariationを描画してから記録する"
+        )
+
+    def handle(self, *args, **options):
+        targets = [
+            (ProfileImage.objects.all(), "picture"),
+            (RoomV4.objects.exclude(image="").exclude(image=None), "image"),
+            (DefaultRoomImage.objects.all(), "image"),
+        ]
+        for queryset, field_name in targets:
+            for instance in queryset:
+                image_field = getattr(instance, field_name)
+                if not image_field:
+                    continue
+                variation_names = []
+                for variation_name, variation in image_field.field.variations.items():
+                    file_name = image_field.get_variation_name(
+                        image_field.name, variation_name
+                    )
+                    if not image_field.storage.exists(file_name):
+                        if not options["render"] or not image_field.storage.exists(
+                            image_field.name
+                        ):
+                            continue
+                        image_field.render_variation(
+                            image_field.name, variation, storage=image_field.storage
+                        )
+                    variation_names.append(variation_name)
+                record_image_variants(image_field.name, variation_names)
+                variants = ",".join(sorted(variation_names))
+                type(instance).objects.filter(pk=instance.pk).update(
+                    **{get_variants_field_name(field_name): variants}
+                )
+                print(f"{image_field.name}: {', '.join(variation_names) or 'なし'}")
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from chat.models import MessageV4, RoomV4
+
+
+class Command(BaseCommand):
+    help = "seq導入前のメッセージを含め, ルームごとにメッセージを時刻順に採番し直す (導入直後に実行)"
+
+    def handle(self, *args, **options):
+        room_ids = (
+            MessageV4.objects.filter(seq__isnull=True)
+            .values_list("room_id", flat=True)
+            .distinct()
+        )
+        for room_id in room_ids:
+            with transaction.atomic():
+                # 採番(create_messages_with_seq)と競合しないようルームをロックする
+                room = RoomV4.objects.select_for_update().get(id=room_id)
+                messages = list(
+                    MessageV4.objects.filter(room=room).order_by("time", "seq", "id")
+                )
+                # (room, seq)のunique制約に抵触しないよう, 一度クリアしてから採番する
+                MessageV4.objects.filter(room=room).update(seq=None)
+                for seq, message in enumerate(messages, start=1):
+                    message.seq = seq
+                MessageV4.objects.bulk_update(messages, ["seq"], batch_size=500)
+                room.last_message_seq = len(messages)
+                room.save(update_fields=["last_message_seq"])
+            print(f"「{room}」の{len(messages)}件のメッセージを採番しました。")
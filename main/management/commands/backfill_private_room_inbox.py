@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from chat.models import RoomV4
+from fullfii.db.chat import fan_out_private_room
+
+
+class Command(BaseCommand):
+    help = "公開中のプライベートルームをinboxへ書き込む (inbox導入前に作成されたルーム用)"
+
+    def handle(self, *args, **options):
+        private_rooms = RoomV4.objects.filter(
+            is_private=True, is_active=True, is_end=False
+        ).select_related("owner")
+        for private_room in private_rooms:
+            recipient_ids = fan_out_private_room(private_room)
+            print(f"「{private_room}」を{len(recipient_ids)}人のinboxへ書き込みました。")
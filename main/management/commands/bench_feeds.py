@@ -0,0 +1,227 @@
+import json
+import math
+import random
+import subprocess
+import time
+import uuid
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from account.models import Account, FavoriteUserRelationship, Gender
+from chat.models import DefaultRoomImage, RoomV4
+from chat.v4.views import private_rooms_api_view, rooms_api_view, talk_info_api_view
+from fullfii.db.chat import (
+    build_room_feed_snapshot,
+    bump_feed_generation,
+    get_feed_generation,
+)
+from fullfii.lib.cache_store import LocalCacheStore, override_cache_store
+
+
+class Rollback(Exception):
+    pass
+
+
+def percentile(values, p):
+    # nearest-rank
+    sorted_values = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+# 投入データはORMで作成する (本番環境にはテスト用のfactory_boyがないため)
+def create_bench_account(**kwargs):
+    return Account.objects.create(username=uuid.uuid4().hex[:15], **kwargs)
+
+
+def create_bench_default_image():
+    # 画像ファイルは作成しない (URLの生成のみ)
+    return DefaultRoomImage.objects.create(
+        file_name="bench", image="bench/default_room_image.png"
+    )
+
+
+def create_bench_room(owner, participants=(), **kwargs):
+    room = RoomV4.objects.create(name="bench", owner=owner, **kwargs)
+    if participants:
+        room.participants.add(*participants)
+    return room
+
+
+class Command(BaseCommand):
+    help = "大量データを投入し, ルームフィード・トーク情報APIのレイテンシ(p50/p95)とクエリ数をJSONで出力"
+
+    endpoints = {
+        "rooms": ("/api/v4/rooms/", rooms_api_view),
+        "private_rooms": ("/api/v4/private-rooms/", private_rooms_api_view),
+        "talk_info": ("/api/v4/me/talk-info/", talk_info_api_view),
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument("--accounts", type=int, default=1000)
+        parser.add_argument("--rooms", type=int, default=300)
+        parser.add_argument("--hidden", type=int, default=20, help="閲覧者ごとの非表示・ブロックルーム数")
+        parser.add_argument("--blocked", type=int, default=20, help="閲覧者ごとのブロックアカウント数")
+        parser.add_argument("--favorites", type=int, default=30, help="閲覧者をまた話したいユーザに登録した人数")
+        parser.add_argument("--heavy-factor", type=int, default=10, help="heavy blockerの非表示・ブロック倍率")
+        parser.add_argument("--iterations", type=int, default=20)
+        parser.add_argument("--cold", action="store_true", help="リクエスト毎にフィードキャッシュを無効化 (snapshot未構築時のクエリを計測)")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", type=str, default="", help="結果JSONの出力先 (未指定時は標準出力)")
+        parser.add_argument("--keep", action="store_true", help="投入データをロールバックしない")
+
+    def handle(self, *args, **options):
+        random.seed(options["seed"])
+        # ロールバックするデータのフィード・ルームのキャッシュを共有のredisへ書き込まない
+        with override_cache_store(LocalCacheStore()):
+            try:
+                with transaction.atomic():
+                    viewers = self.seed(options)
+                    results = {
+                        profile: self.measure(viewer, options)
+                        for profile, viewer in viewers.items()
+                    }
+                    if not options["keep"]:
+                        raise Rollback
+            except Rollback:
+                pass
+        if options["keep"]:
+            # 投入したデータを共有のフィードキャッシュへ反映
+            bump_feed_generation()
+
+        report = {
+            "revision": self.get_revision(),
+            "params": {
+                key: options[key]
+                for key in [
+                    "accounts",
+                    "rooms",
+                    "hidden",
+                    "blocked",
+                    "favorites",
+                    "heavy_factor",
+                    "iterations",
+                    "cold",
+                    "seed",
+                ]
+            },
+            "results": results,
+        }
+        report_json = json.dumps(report, indent=2, ensure_ascii=False)
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as f:
+                f.write(report_json)
+            self.stdout.write("{}へ出力しました".format(options["output"]))
+        else:
+            self.stdout.write(report_json)
+
+    def seed(self, options):
+        default_image = create_bench_default_image()
+        genders = [Gender.MALE, Gender.FEMALE, Gender.NOTSET]
+
+        accounts = [
+            create_bench_account(
+                gender=random.choice(genders),
+                is_secret_gender=random.random() < 0.1,
+                is_ban=random.random() < 0.05,
+            )
+            for _ in range(options["accounts"])
+        ]
+
+        def create_room(owner, **kwargs):
+            room_kwargs = {
+                "default_image": default_image,
+                "image": None,
+                "is_active": True,
+                "is_private": random.random() < 0.2,
+                "is_exclude_different_gender": random.random() < 0.3,
+            }
+            room_kwargs.update(kwargs)
+            return create_bench_room(owner, **room_kwargs)
+
+        rooms = [
+            create_room(
+                owner,
+                participants=[random.choice(accounts)] if random.random() < 0.2 else [],
+            )
+            for owner in random.sample(accounts, min(options["rooms"], len(accounts)))
+        ]
+
+        viewers = {
+            "male": create_bench_account(gender=Gender.MALE),
+            "female": create_bench_account(gender=Gender.FEMALE),
+            "banned": create_bench_account(gender=Gender.MALE, is_ban=True),
+            "secret_gender": create_bench_account(
+                gender=Gender.FEMALE, is_secret_gender=True
+            ),
+            "heavy_blocker": create_bench_account(gender=Gender.FEMALE),
+        }
+        for profile, viewer in viewers.items():
+            factor = options["heavy_factor"] if profile == "heavy_blocker" else 1
+            num_hidden = min(options["hidden"] * factor, len(rooms))
+            viewer.hidden_rooms.add(*random.sample(rooms, num_hidden))
+            viewer.blocked_rooms.add(*random.sample(rooms, num_hidden))
+            num_blocked = min(options["blocked"] * factor, len(accounts))
+            viewer.blocked_accounts.add(*random.sample(accounts, num_blocked))
+            for blocker in random.sample(accounts, num_blocked):
+                blocker.blocked_accounts.add(viewer)
+
+            FavoriteUserRelationship.objects.bulk_create(
+                [
+                    FavoriteUserRelationship(owner=owner, favorite_account=viewer)
+                    for owner in random.sample(
+                        accounts, min(options["favorites"], len(accounts))
+                    )
+                ]
+            )
+
+            # トーク情報用に作成ルーム・参加ルームを1つずつ
+            create_room(viewer, is_private=False, participants=[random.choice(accounts)])
+            create_room(random.choice(accounts), is_private=False, participants=[viewer])
+
+        return viewers
+
+    def measure(self, viewer, options):
+        request_factory = APIRequestFactory()
+        results = {}
+        for endpoint, (url, view) in self.endpoints.items():
+            latencies = []
+            query_counts = []
+            if not options["cold"]:
+                # 投入データは未commitのため, バックグラウンドではなくこのスレッドで構築する
+                build_room_feed_snapshot(get_feed_generation())
+            for _ in range(options["iterations"]):
+                if options["cold"]:
+                    bump_feed_generation()
+                request = request_factory.get(url)
+                force_authenticate(request, user=viewer)
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.perf_counter()
+                    response = view(request)
+                    response.render()
+                    latencies.append((time.perf_counter() - start) * 1000)
+                query_counts.append(len(queries))
+
+            results[endpoint] = {
+                "p50_ms": round(percentile(latencies, 50), 3),
+                "p95_ms": round(percentile(latencies, 95), 3),
+                "mean_ms": round(sum(latencies) / len(latencies), 3),
+                "queries_p50": percentile(query_counts, 50),
+                "queries_max": max(query_counts),
+                "status_code": response.status_code,
+            }
+        return results
+
+    def get_revision(self):
+        try:
+            return (
+                subprocess.check_output(
+                    ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL
+                )
+                .decode()
+                .strip()
+            )
+        except (OSError, subprocess.CalledProcessError):
+            return ""
@@ -0,0 +1,100 @@
+import json
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chat.models import MessageV4
+from chat.v4.fast_serializers import serialize_message, serialize_rooms
+from chat.v4.serializers import MessageSerializer, RoomSerializer
+from fullfii.db.account import get_favorite_user_ids
+from fullfii.db.chat import load_rooms
+from main.management.commands.bench_feeds import (
+    Rollback,
+    create_bench_account,
+    create_bench_default_image,
+    create_bench_room,
+    percentile,
+)
+
+
+class Command(BaseCommand):
+    help = "RoomSerializer・MessageSerializer(DRF)と高速シリアライザの処理時間(p50/p95)をJSONで出力"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rooms", type=int, default=10)
+        parser.add_argument("--participants", type=int, default=3, help="ルームごとの参加者数")
+        parser.add_argument("--messages", type=int, default=200)
+        parser.add_argument("--iterations", type=int, default=50)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                me, rooms, messages = self.seed(options)
+                favorite_user_ids = get_favorite_user_ids(me)
+                targets = {
+                    "rooms_drf": lambda: RoomSerializer(
+                        rooms, many=True, context={"me": me}
+                    ).data,
+                    "rooms_fast": lambda: serialize_rooms(rooms, favorite_user_ids),
+                    "messages_drf": lambda: MessageSerializer(messages, many=True).data,
+                    "messages_fast": lambda: [
+                        serialize_message(message) for message in messages
+                    ],
+                }
+                results = {
+                    name: self.measure(target, options["iterations"])
+                    for name, target in targets.items()
+                }
+                raise Rollback
+        except Rollback:
+            pass
+
+        for kind in ["rooms", "messages"]:
+            results[f"{kind}_speedup"] = round(
+                results[f"{kind}_drf"]["p50_ms"] / results[f"{kind}_fast"]["p50_ms"], 2
+            )
+        report = {
+            "params": {
+                key: options[key]
+                for key in ["rooms", "participants", "messages", "iterations"]
+            },
+            "results": results,
+        }
+        self.stdout.write(json.dumps(report, indent=2, ensure_ascii=False))
+
+    def seed(self, options):
+        default_image = create_bench_default_image()
+        me = create_bench_account()
+        rooms = [
+            create_bench_room(
+                create_bench_account(),
+                participants=[
+                    create_bench_account() for _ in range(options["participants"])
+                ],
+                default_image=default_image,
+                image=None,
+            )
+            for _ in range(options["rooms"])
+        ]
+        messages = MessageV4.objects.bulk_create(
+            [
+                MessageV4(room=rooms[0], sender=me, text=f"message {i}")
+                for i in range(options["messages"])
+            ]
+        )
+        # 計測対象外とするため, メンバー・送信者は事前に取得しておく
+        rooms = load_rooms([room.id for room in rooms])
+        messages = list(MessageV4.objects.filter(room=rooms[0]).select_related("sender"))
+        return me, rooms, messages
+
+    def measure(self, target, iterations):
+        latencies = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            target()
+            latencies.append((time.perf_counter() - start) * 1000)
+        return {
+            "p50_ms": round(percentile(latencies, 50), 3),
+            "p95_ms": round(percentile(latencies, 95), 3),
+        }
+
@@ -0,0 +1,51 @@
+from datetime import timedelta
+from django.db.models import Max
+from django.core.management.base import BaseCommand
+from chat.models import MessageV4, RoomMemberWatermark, RoomV4
+
+
+class Command(BaseCommand):
+    help = "MessageV4.read_participants, stored_on_participantsをRoomMemberWatermarkへ変換する"
+
+    def handle(self, *args, **options):
+        # 既読・保存はルーム単位(その時点の全メッセージ)で行われるため, マーク済みの最新メッセージの時刻を位置とする
+        last_read_ats = {
+            (row["messagev4__room_id"], row["account_id"]): row["last_time"]
+            for row in MessageV4.read_participants.through.objects.values(
+                "messagev4__room_id", "account_id"
+            ).annotate(last_time=Max("messagev4__time"))
+        }
+        last_stored_ats = {
+            (row["messagev4__room_id"], row["account_id"]): row["last_time"]
+            for row in MessageV4.stored_on_participants.through.objects.values(
+                "messagev4__room_id", "account_id"
+            ).annotate(last_time=Max("messagev4__time"))
+        }
+
+        # 保存はメッセージ単位でも行われるため, 最新の保存済みメッセージより前に未保存のメッセージがある場合は,
+        # 最も古い未保存のメッセージの直前を位置とする (未保存のメッセージを保存済みにしないため)
+        for (room_id, member_id), last_stored_at in last_stored_ats.items():
+            oldest_not_stored_time = (
+                MessageV4.objects.filter(room_id=room_id, time__lte=last_stored_at)
+                .exclude(stored_on_participants=member_id)
+                .order_by("time")
+                .values_list("time", flat=True)
+                .first()
+            )
+            if oldest_not_stored_time is not None:
+                last_stored_ats[(room_id, member_id)] = (
+                    oldest_not_stored_time - timedelta(microseconds=1)
+                )
+
+        for room_id, member_id in set(last_read_ats) | set(last_stored_ats):
+            RoomMemberWatermark.objects.update_or_create(
+                room_id=room_id,
+                member_id=member_id,
+                defaults={
+                    "last_read_at": last_read_ats.get((room_id, member_id)),
+                    "last_stored_at": last_stored_ats.get((room_id, member_id)),
+                },
+            )
+        print(
+            f"{len(set(last_read_ats) | set(last_stored_ats))}件の既読・保存済み位置を作成しました。"
+        )
@@ -0,0 +1,48 @@
+from django.db.models import Prefetch
+from django.core.management.base import BaseCommand
+from chat.models import MessageV4, RoomMemberWatermark, RoomV4
+
+
+class Command(BaseCommand):
+    help = "RoomMemberWatermark.unread_count(バッジ用の未読数)を既読位置から再計算し, ずれを修復する"
+
+    def handle(self, *args, **options):
+        num_fixed = 0
+
+        # 非活性のルームは全員クローズ済み
+        num_fixed += RoomMemberWatermark.objects.filter(
+            room__is_active=False, unread_count__gt=0
+        ).update(unread_count=0)
+
+        rooms = RoomV4.objects.filter(is_active=True).prefetch_related(
+            "participants",
+            "closed_members",
+            Prefetch("member_watermarks", to_attr="watermarks"),
+        )
+        for room in rooms:
+            closed_member_ids = {member.id for member in room.closed_members.all()}
+            member_ids = {room.owner_id, *[p.id for p in room.participants.all()]}
+            watermarks = {watermark.member_id: watermark for watermark in room.watermarks}
+
+            for member_id in member_ids | set(watermarks):
+                watermark = watermarks.get(member_id)
+                if member_id in closed_member_ids or member_id not in member_ids:
+                    unread_count = 0
+                else:
+                    messages = MessageV4.objects.filter(room=room)
+                    if watermark is not None and watermark.last_read_at is not None:
+                        messages = messages.filter(time__gt=watermark.last_read_at)
+                    unread_count = messages.count()
+
+                if watermark is None:
+                    if unread_count > 0:
+                        RoomMemberWatermark.objects.create(
+                            room=room, member_id=member_id, unread_count=unread_count
+                        )
+                        num_fixed += 1
+                elif watermark.unread_count != unread_count:
+                    RoomMemberWatermark.objects.filter(id=watermark.id).update(
+                        unread_count=unread_count
+                    )
+                    num_fixed += 1
+        print(f"{num_fixed}件の未読数を修復しました。")
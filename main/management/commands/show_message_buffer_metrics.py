@@ -0,0 +1,12 @@
+import json
+from django.core.management.base import BaseCommand
+from fullfii.db.message_buffer import get_message_buffer_metrics
+
+
+class Command(BaseCommand):
+    help = "メッセージwrite-behindバッファのワーカーごとのメトリクス(バッファ件数, flush時間等)をJSONで出力"
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            json.dumps(get_message_buffer_metrics(), indent=2, ensure_ascii=False)
+        )
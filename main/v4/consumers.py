@@ -1,16 +1,37 @@
+import asyncio
 import traceback
+import uuid
+from collections import namedtuple
 from channels.db import database_sync_to_async
 from asgiref.sync import async_to_sync
-import json
+from fullfii.lib import json_codec
 from abc import abstractmethod
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.layers import get_channel_layer
+from django.db import transaction
 
 from account.models import Account
 from account.v4.serializers import MeSerializer, UserSerializer
+from chat.models import PrivateRoomInbox
+from chat.v4.serializers import RoomSerializer
+from fullfii.db.chat import (
+    FeedEntry,
+    FeedSegmentKey,
+    FeedViewerExclusion,
+    RoomFeedVisibilityEngine,
+    get_user_version,
+)
 from fullfii.lib.authSupport import authenticate_jwt
 
 
+# NotificationConsumerが保持するフィード閲覧者の不変スナップショット. Modelオブジェクトは保持しない.
+# exclusions: {feed: FeedViewerExclusion} プライベートルームは会話中のユーザを除外しない
+FeedViewerSnapshot = namedtuple(
+    "FeedViewerSnapshot",
+    ["version", "gender", "is_secret_gender", "is_ban", "exclusions"],
+)
+
+
 class JWTAsyncWebsocketConsumer(AsyncWebsocketConsumer):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -49,9 +70,20 @@ class JWTAsyncWebsocketConsumer(AsyncWebsocketConsumer):
     async def _receive(self, received_data):
         pass  # receive other than auth
 
+    @classmethod
+    def decode_json(cls, text_data):
+        return json_codec.loads(text_data)
+
+    @classmethod
+    def encode_json(cls, content):
+        return json_codec.dumps(content)
+
+    async def send_json(self, content, close=False):
+        await self.send(text_data=self.encode_json(content), close=close)
+
     async def receive(self, text_data):
         try:
-            received_data = json.loads(text_data)
+            received_data = self.decode_json(text_data)
 
             # receive jwt token to authenticate
             if "type" in received_data and received_data["type"] == "auth":
@@ -60,10 +92,8 @@ class JWTAsyncWebsocketConsumer(AsyncWebsocketConsumer):
                     self.is_authenticated = True
             else:
                 if not self.is_authenticated:
-                    await self.send(
-                        text_data=json.dumps(
-                            {"type": "error", "message": "Unauthorized error."}
-                        )
+                    await self.send_json(
+                        {"type": "error", "message": "Unauthorized error."}
                     )
                     return
                 await self._receive(received_data)
@@ -74,7 +104,7 @@ class JWTAsyncWebsocketConsumer(AsyncWebsocketConsumer):
     @database_sync_to_async
     def get_user(self, user_id):
         try:
-            return Account.objects.get(id=user_id)
+            return Account.objects.select_related("image").get(id=user_id)
         except Exception as e:
             traceback.print_exc()
 
@@ -88,12 +118,23 @@ class JWTAsyncWebsocketConsumer(AsyncWebsocketConsumer):
 
 
 class NotificationConsumer(JWTAsyncWebsocketConsumer):
+    feed_group_name = "feed"  # 公開ルームフィードの差分を購読しているconsumer
+    feed_delta_window = 0.5  # 差分をまとめて送信する間隔(秒)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.is_feed_subscribed = False
+        self.pending_feed_deltas = {}  # {(feed, room_id): delta} 同一ルームの差分は最新のみ残す
+        self.feed_delta_flush_task = None
+        self.feed_viewer_snapshot = None
+
     @classmethod
     def get_group_name(cls, _id):
         return "notification_{}".format(str(_id))
 
     async def _disconnect(self, close_code):
-        pass  # 切断時特別な処理はしない
+        if self.is_feed_subscribed:
+            await self.unsubscribe_feed()
 
     async def receive_auth(self, received_data):
         """
@@ -116,18 +157,143 @@ class NotificationConsumer(JWTAsyncWebsocketConsumer):
         self.group_name = self.get_group_name(self.me_id)
         await self.channel_layer.group_add(self.group_name, self.channel_name)
 
-        await self.send(text_data=json.dumps({"type": "auth"}))
+        await self.send_json({"type": "auth"})
         return True
 
     async def _receive(self, received_data):
-        pass  # 受信を受け付けない
+        received_type = received_data["type"] if "type" in received_data else ""
+
+        # ルームフィード(rooms, private_rooms)の差分の購読. 購読後は差分がfeed_deltaで送信される
+        if received_type == "subscribe_feed":
+            if not self.is_feed_subscribed:
+                self.is_feed_subscribed = True
+                await self.channel_layer.group_add(
+                    self.feed_group_name, self.channel_name
+                )
+            await self.send_json({"type": "subscribe_feed"})
+
+        elif received_type == "unsubscribe_feed":
+            if self.is_feed_subscribed:
+                await self.unsubscribe_feed()
+            await self.send_json({"type": "unsubscribe_feed"})
+
+    async def unsubscribe_feed(self):
+        self.is_feed_subscribed = False
+        self.pending_feed_deltas = {}
+        if self.feed_delta_flush_task is not None:
+            self.feed_delta_flush_task.cancel()
+            self.feed_delta_flush_task = None
+        await self.channel_layer.group_discard(self.feed_group_name, self.channel_name)
+
+    async def feed_delta(self, event):
+        if not self.is_feed_subscribed:
+            return
+        delta = event["delta"]
+        key = (delta["feed"], delta["room_id"])
+        pending_delta = self.pending_feed_deltas.pop(key, None)
+        if (
+            pending_delta is not None
+            and "room" in pending_delta
+            and "room" not in delta
+            and delta["action"] != "removed"
+        ):
+            # added => full等をまとめる場合, ルームのデータを残す
+            delta = {**delta, "room": pending_delta["room"]}
+        self.pending_feed_deltas[key] = delta
+        if self.feed_delta_flush_task is None:
+            self.feed_delta_flush_task = asyncio.ensure_future(
+                self.flush_feed_deltas()
+            )
+
+    async def flush_feed_deltas(self):
+        try:
+            await asyncio.sleep(self.feed_delta_window)
+            deltas = list(self.pending_feed_deltas.values())
+            self.pending_feed_deltas = {}
+            self.feed_delta_flush_task = None
+
+            visible_deltas = await self.filter_feed_deltas(deltas)
+            if visible_deltas:
+                await self.send_json({"type": "feed_delta", "deltas": visible_deltas})
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            traceback.print_exc()
+
+    @database_sync_to_async
+    def filter_feed_deltas(self, deltas):
+        """
+        フィードAPIと同じ表示ルールを適用する. 表示できなくなったルームはroom_removedとして送信する.
+        """
+        viewer = self.get_feed_viewer_snapshot()
+
+        visible_deltas = []
+        for delta in deltas:
+            action = delta["action"]
+            if action != "removed":
+                segment_key = FeedSegmentKey(*delta["segment_key"])
+                entry = FeedEntry(
+                    None, uuid.UUID(delta["room_id"]), uuid.UUID(delta["owner_id"])
+                )
+                if delta["feed"] == "private_rooms":
+                    is_visible = not segment_key.owner_is_ban
+                else:
+                    is_visible = RoomFeedVisibilityEngine.is_segment_visible(
+                        segment_key, viewer
+                    )
+                exclusion = viewer.exclusions[delta["feed"]]
+                is_visible = is_visible and not exclusion.excludes(entry)
+
+                if not is_visible:
+                    if action == "updated":
+                        action = "removed"
+                    else:
+                        continue
+
+            visible_delta = {
+                "type": {
+                    "added": "room_added",
+                    "updated": "room_added",
+                    "full": "room_full",
+                    "removed": "room_removed",
+                }[action],
+                "feed": delta["feed"],
+                "room_id": delta["room_id"],
+            }
+            if action != "removed" and "room" in delta:
+                visible_delta["room"] = delta["room"]
+            visible_deltas.append(visible_delta)
+        return visible_deltas
+
+    def get_feed_viewer_snapshot(self):
+        """
+        非表示・ブロック・参加・性別・凍結等の変更時はユーザのバージョンが変わるため,
+        バージョンが変わった場合のみ再取得する (flushごとに閲覧者・除外対象を読み込まない)
+        """
+        version = get_user_version(self.me_id)
+        if (
+            self.feed_viewer_snapshot is None
+            or self.feed_viewer_snapshot.version != version
+        ):
+            viewer = Account.objects.get(id=self.me_id)
+            self.feed_viewer_snapshot = FeedViewerSnapshot(
+                version=version,
+                gender=viewer.gender,
+                is_secret_gender=viewer.is_secret_gender,
+                is_ban=viewer.is_ban,
+                exclusions={
+                    "rooms": FeedViewerExclusion.create(viewer),
+                    "private_rooms": FeedViewerExclusion.create(
+                        viewer, exclude_talking_members=False
+                    ),
+                },
+            )
+        return self.feed_viewer_snapshot
 
     async def notice_talk(self, event):
         try:
-            appended_data = event["context"]
-            data = {"type": "notice_talk"}
-            data.update(appended_data)
-            await self.send(text_data=json.dumps(data))
+            # フレームは送信側でエンコード済み
+            await self.send(text_data=event["frame"])
         except Exception as e:
             traceback.print_exc()
 
@@ -141,11 +307,61 @@ class NotificationConsumer(JWTAsyncWebsocketConsumer):
             group_name,
             {
                 "type": "notice_talk",
-                "context": {
-                    "status": "SOMEONE_PARTICIPATED",
-                    "room": room_data,
-                    "participant_id": participant_id,
-                    "should_start": should_start,
-                },
+                "frame": cls.encode_json(
+                    {
+                        "type": "notice_talk",
+                        "status": "SOMEONE_PARTICIPATED",
+                        "room": room_data,
+                        "participant_id": participant_id,
+                        "should_start": should_start,
+                    }
+                ),
             },
         )
+
+    @classmethod
+    def send_feed_delta(cls, action, room, recipient_ids=None):
+        """
+        ルームフィードの差分を送信する.
+        action: "added"(作成) | "updated"(変更. 表示できなくなった場合room_removed) | "full"(満員) | "removed"(終了・非活性)
+        プライベートルームはinboxの受信者へ, それ以外はフィード購読グループへ送信する.
+        トランザクション内ではcommit後に送信する (受信したクライアントがAPIで取得できるように)
+        """
+        delta = {
+            "action": action,
+            "feed": "private_rooms" if room.is_private else "rooms",
+            "room_id": str(room.id),
+            "owner_id": str(room.owner.id),
+            "segment_key": [
+                room.owner.gender,
+                room.owner.is_secret_gender,
+                room.owner.is_ban,
+                room.is_exclude_different_gender,
+            ],
+        }
+        if action in ("added", "updated"):
+            delta["room"] = RoomSerializer(room).data
+
+        if room.is_private:
+            if recipient_ids is None:
+                recipient_ids = PrivateRoomInbox.objects.filter(room=room).values_list(
+                    "recipient_id", flat=True
+                )
+            group_names = [cls.get_group_name(recipient_id) for recipient_id in recipient_ids]
+        else:
+            group_names = [cls.feed_group_name]
+
+        def send():
+            channel_layer = get_channel_layer()
+            for group_name in group_names:
+                async_to_sync(channel_layer.group_send)(
+                    group_name, {"type": "feed_delta", "delta": delta}
+                )
+
+        transaction.on_commit(send)
+
+    @classmethod
+    def send_feed_deltas_of_owner(cls, action, owner):
+        """オーナーの公開中ルームの差分を送信する (凍結・退会・性別変更時)"""
+        for room in owner.roomv4_set.filter(is_active=True, is_end=False):
+            cls.send_feed_delta(action, room)